@@ -0,0 +1,290 @@
+"""
+Benchmark end-to-end không cần Instagram / Telegram thật.
+
+Dựng FakeInstagram, FakeCDN và FakeBotAPI cục bộ rồi chạy từng kịch bản (photo, reel,
+carousel 10 item, story batch) theo hai cách:
+
+- download: gọi thẳng download_instagram_content / download_instagram_story
+- bot:      gửi update qua process_instagram_url, đo tới khi job gửi xong lên Bot API giả
+
+In p50/p95/p99 latency, throughput và peak RSS của từng kịch bản.
+
+    python benchmarks/bench.py --requests 50 --concurrency 8 --cdn-bandwidth 5000000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fakes  # noqa: E402
+
+SCENARIOS = {
+    "photo": ("photo", 1),
+    "reel": ("reel", 1),
+    "carousel": ("carousel", 10),
+    "story": ("story", 0),
+}
+SHORTCODE_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+
+
+def configure_env(name: str = "benchmark", unthrottled: bool = True, **overrides) -> None:
+    """
+    Đặt env trước khi import instagrap (dùng chung cho bench.py và loadtest.py): tài khoản giả, cache trong RAM.
+    unthrottled: bỏ giới hạn tốc độ Instagram/CDN/chat để không làm nghẽn benchmark.
+    overrides: env riêng của từng công cụ. Env người dùng đã đặt luôn được giữ.
+    """
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", f"123456:{name}")
+    os.environ.setdefault("INSTAGRAM_USERNAME", name)
+    os.environ.setdefault("INSTAGRAM_PASSWORD", name)
+    os.environ.setdefault("INSTAGRAM_EXTRA_ACCOUNTS", "")
+    os.environ.setdefault("FILE_ID_CACHE_PATH", ":memory:")
+    os.environ.setdefault("MEDIA_META_CACHE_PATH", ":memory:")
+    # Media giả trùng nội dung nhau: tắt cache đĩa để mỗi request đều tải thật
+    os.environ.setdefault("MEDIA_CACHE_MAX_BYTES", "0")
+    if unthrottled:
+        for key in ("RATE_LIMIT_MEDIA_INFO", "RATE_LIMIT_STORIES", "RATE_LIMIT_CDN", "USER_RATE_LIMIT"):
+            os.environ.setdefault(key, "10000,10000")
+    for key, value in overrides.items():
+        os.environ.setdefault(key, value)
+
+
+def percentile(values: list, q: float) -> float:
+    """Nearest-rank percentile, q trong [0, 1]."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered) + 0.5)) - 1))]
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Không có /proc (macOS): chỉ có peak của cả tiến trình
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class RssSampler:
+    """Lấy mẫu RSS định kỳ trong lúc chạy một kịch bản để có peak riêng của kịch bản đó."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak = 0
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            self.peak = max(self.peak, rss_bytes())
+            await asyncio.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = rss_bytes()
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+        self.peak = max(self.peak, rss_bytes())
+
+
+class Bench:
+    def __init__(self, ig, instagram: fakes.FakeInstagram, bot_api: fakes.FakeBotAPI, args):
+        self.ig = ig
+        self.instagram = instagram
+        self.bot_api = bot_api
+        self.args = args
+        self.application = None
+        self._counter = 0
+        self._done = {}
+
+    def _shortcode(self) -> str:
+        # Mỗi request một bài mới để không trúng cache file_id / media_info / singleflight
+        self._counter += 1
+        n, code = self._counter + 10 ** 9, ""
+        while n:
+            n, r = divmod(n, 64)
+            code = SHORTCODE_ALPHABET[r] + code
+        return "B" + code
+
+    def new_url(self, scenario: str) -> str:
+        kind, items = SCENARIOS[scenario]
+        if kind == "story":
+            self._counter += 1
+            return f"https://www.instagram.com/stories/bench{self._counter}/"
+        shortcode = self._shortcode()
+        self.instagram.add_post(self.ig.cl.media_pk_from_code(shortcode), kind, items)
+        return f"https://www.instagram.com/p/{shortcode}/"
+
+    async def download_once(self, url: str) -> None:
+        """Driver download: chỉ bước Instagram + CDN, xoá file sau mỗi request."""
+        match = self.ig.re.search(self.ig.INSTAGRAM_URL_PATTERN, url)
+        if "/stories/" in url:
+            items = await self.ig.download_instagram_story(match.group(1))
+        else:
+            items = await self.ig.download_instagram_content(match.group(1))
+        if not items:
+            raise RuntimeError(f"Không tải được {url}")
+        self.ig.media_leases.release(self.ig._media_paths(items))
+
+    async def _run_job(self, job) -> None:
+        try:
+            await self.ig.run_download_job(job)
+        finally:
+            future = self._done.pop(job.url, None)
+            if future is not None and not future.done():
+                # Kết quả job nằm trên span gốc (ok / failed / gave_up / unavailable...)
+                outcome = job.trace.attrs.get("outcome") if job.trace else "ok"
+                if outcome == "ok":
+                    future.set_result(None)
+                else:
+                    future.set_exception(RuntimeError(f"job kết thúc với outcome={outcome}"))
+
+    async def bot_once(self, url: str) -> None:
+        """Driver bot: update đi qua process_instagram_url, job_queue và Bot API giả."""
+        self._counter += 1
+        chat_id = 10_000 + self._counter
+        update = self.ig.Update.de_json({
+            "update_id": self._counter,
+            "message": {
+                "message_id": self._counter, "date": int(time.time()), "text": url,
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+            },
+        }, self.application.bot)
+        future = asyncio.get_running_loop().create_future()
+        self._done[url] = future
+        await self.ig.process_instagram_url(update, None)
+        await future
+
+    async def run_scenario(self, scenario: str, driver: str) -> dict:
+        once = self.bot_once if driver == "bot" else self.download_once
+        urls = [self.new_url(scenario) for _ in range(self.args.requests)]
+        latencies, errors = [], 0
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def one(url: str) -> None:
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    await once(url)
+                except Exception as e:
+                    errors += 1
+                    print(f"  lỗi {url}: {e}", file=sys.stderr)
+                    return
+                latencies.append(time.perf_counter() - started)
+
+        with RssSampler() as rss:
+            started = time.perf_counter()
+            await asyncio.gather(*(one(url) for url in urls))
+            wall = time.perf_counter() - started
+        return {
+            "scenario": scenario, "driver": driver, "requests": len(urls), "errors": errors,
+            "p50": percentile(latencies, 0.50), "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99), "throughput": len(latencies) / wall if wall else 0.0,
+            "peak_rss": rss.peak,
+        }
+
+    async def start_bot(self) -> None:
+        ig = self.ig
+        self.application = (
+            ig.Application.builder().token(ig.Config.TOKEN).base_url(self.bot_api.base + "/bot").build()
+        )
+        await self.application.initialize()
+        ig.job_queue.start(self._run_job)
+
+    async def stop_bot(self) -> None:
+        await self.ig.job_queue.stop()
+        await self.application.shutdown()
+
+
+def print_report(results: list) -> None:
+    header = f"{'scenario':<10} {'driver':<9} {'n':>5} {'err':>4} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} {'req/s':>8} {'peak RSS MB':>12}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['scenario']:<10} {r['driver']:<9} {r['requests']:>5} {r['errors']:>4} "
+            f"{r['p50']:>8.3f} {r['p95']:>8.3f} {r['p99']:>8.3f} {r['throughput']:>8.2f} "
+            f"{r['peak_rss'] / 1024 ** 2:>12.1f}"
+        )
+
+
+async def main(args) -> list:
+    cdn = fakes.FakeCDN(ttfb=args.cdn_ttfb, bandwidth=args.cdn_bandwidth)
+    await cdn.start()
+    instagram = fakes.FakeInstagram(
+        cdn.base, latency=args.instagram_latency, photo_size=args.photo_size,
+        video_size=args.video_size, stories_per_user=args.stories,
+    )
+    await instagram.start()
+    bot_api = fakes.FakeBotAPI(latency=args.bot_latency, bandwidth=args.upload_bandwidth)
+    await bot_api.start()
+
+    import instagrap as ig
+    logging.getLogger().setLevel(args.log_level)
+    # FakeInstagram cố ý trả body rỗng cho endpoint public; instagrapi log ERROR cho mỗi lần như vậy
+    for name in ("public_request", "private_request"):
+        logging.getLogger(name).setLevel(logging.CRITICAL)
+    for account in ig.client_pool.accounts:
+        fakes.redirect_instagrapi(account.client, instagram.base)
+    ig.http_session = ig.create_http_session()
+
+    bench = Bench(ig, instagram, bot_api, args)
+    results = []
+    try:
+        if "bot" in args.drivers:
+            await bench.start_bot()
+        # Làm nóng: media_strategy_stats học nguồn media_info nào dùng được, không tính vào kết quả
+        for _ in range(args.warmup):
+            await bench.download_once(bench.new_url("photo"))
+        for scenario in args.scenarios:
+            for driver in args.drivers:
+                results.append(await bench.run_scenario(scenario, driver))
+                if args.verbose:
+                    print_report(results[-1:])
+    finally:
+        if "bot" in args.drivers:
+            await bench.stop_bot()
+        await ig.close_http_session()
+        for server in (bot_api, instagram, cdn):
+            await server.stop()
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--drivers", nargs="+", choices=["download", "bot"], default=["download", "bot"])
+    parser.add_argument("--requests", type=int, default=20, help="số request mỗi kịch bản")
+    parser.add_argument("--concurrency", type=int, default=4, help="số request chạy đồng thời")
+    parser.add_argument("--instagram-latency", type=float, default=0.1, help="giây mỗi lời gọi Instagram giả")
+    parser.add_argument("--cdn-ttfb", type=float, default=0.02)
+    parser.add_argument("--cdn-bandwidth", type=float, default=0, help="byte/giây mỗi kết nối CDN, 0 = không giới hạn")
+    parser.add_argument("--bot-latency", type=float, default=0.02, help="giây mỗi lời gọi Bot API giả")
+    parser.add_argument("--upload-bandwidth", type=float, default=0, help="byte/giây mỗi upload, 0 = không giới hạn")
+    parser.add_argument("--photo-size", type=int, default=300_000)
+    parser.add_argument("--video-size", type=int, default=3_000_000)
+    parser.add_argument("--stories", type=int, default=10, help="số story mỗi user trong kịch bản story")
+    parser.add_argument("--warmup", type=int, default=5, help="số request làm nóng trước khi đo")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--verbose", action="store_true", help="in kết quả ngay sau từng kịch bản")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    configure_env(JOB_WORKERS=str(args.concurrency), JOB_QUEUE_MAX="0")
+    # instagram_downloads/ và file session nằm trong thư mục tạm, không đụng vào thư mục bot
+    with tempfile.TemporaryDirectory(prefix="instagrap-bench-") as workdir:
+        os.chdir(workdir)
+        print_report(asyncio.run(main(args)))
@@ -0,0 +1,311 @@
+"""
+Server giả cho benchmark / load test, chạy hoàn toàn cục bộ bằng aiohttp:
+
+- FakeInstagram: các endpoint private API mà instagrapi gọi (media info, usernameinfo, story feed)
+- FakeCDN: trả media với dung lượng, TTFB và băng thông cấu hình được
+- FakeBotAPI: getMe, sendMessage, editMessageText, sendPhoto/Video/Document, sendMediaGroup;
+  đọc hết body multipart như Telegram thật, tự tải media gửi bằng URL (giới hạn 5MB / 20MB)
+
+redirect_instagrapi() gắn adapter vào session requests của instagrapi để mọi request tới
+*.instagram.com đi vào FakeInstagram.
+"""
+import asyncio
+import aiohttp
+import itertools
+import json
+import time
+import zlib
+from urllib.parse import urlsplit
+
+from aiohttp import web
+from requests.adapters import HTTPAdapter
+
+
+async def _serve(app: web.Application, host: str = "127.0.0.1", port: int = 0) -> tuple:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner, f"http://{host}:{site._server.sockets[0].getsockname()[1]}"
+
+
+class FakeCDN:
+    """GET /<tên file>?size=N: trả N byte theo chunk 64KB, giới hạn băng thông mỗi kết nối."""
+
+    CHUNK = 64 * 1024
+
+    def __init__(self, ttfb: float = 0.02, bandwidth: float = 0):
+        self.ttfb = ttfb
+        self.bandwidth = bandwidth  # byte/giây mỗi kết nối, 0 = không giới hạn
+        self.requests = 0
+        self.bytes_sent = 0
+        self.runner = None
+        self.base = None
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        size = int(request.query.get("size", "100000"))
+        await asyncio.sleep(self.ttfb)
+        name = request.match_info["name"]
+        response = web.StreamResponse(headers={
+            "Content-Type": "video/mp4" if name.endswith(".mp4") else "image/jpeg",
+            "Content-Length": str(size),
+        })
+        await response.prepare(request)
+        chunk = b"\0" * self.CHUNK
+        sent = 0
+        while sent < size:
+            part = chunk[:min(self.CHUNK, size - sent)]
+            await response.write(part)
+            sent += len(part)
+            if self.bandwidth:
+                await asyncio.sleep(len(part) / self.bandwidth)
+        self.bytes_sent += sent
+        await response.write_eof()
+        return response
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_get("/{name}", self.handle)
+        self.runner, self.base = await _serve(app)
+        return self.base
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
+
+
+class FakeInstagram:
+    """
+    Private API giả. Bài viết được đăng ký theo media pk (add_post); user story bất kỳ
+    đều có stories_per_user story, xen kẽ ảnh và video, pk riêng theo từng user.
+    """
+
+    def __init__(self, cdn_base: str, latency: float = 0.1, photo_size: int = 300_000,
+                 video_size: int = 3_000_000, stories_per_user: int = 10):
+        self.cdn_base = cdn_base
+        self.latency = latency
+        self.photo_size = photo_size
+        self.video_size = video_size
+        self.stories_per_user = stories_per_user
+        self.posts = {}  # media pk -> ("photo" | "reel" | "carousel", số item)
+        self.requests = 0
+        self.runner = None
+        self.base = None
+
+    def add_post(self, media_pk, kind: str, items: int = 1) -> None:
+        self.posts[str(media_pk)] = (kind, items)
+
+    @staticmethod
+    def _user(username: str) -> dict:
+        return {
+            "pk": str(zlib.crc32(username.encode()) + 1000), "username": username, "full_name": username,
+            "profile_pic_url": "https://example.invalid/p.jpg", "is_private": False, "is_verified": False,
+            "follower_count": 0, "following_count": 0, "media_count": 0, "biography": "",
+            "is_business": False, "external_url": None,
+        }
+
+    def _item(self, pk: str, video: bool, user: dict, taken_at: int) -> dict:
+        item = {
+            "pk": pk, "id": f"{pk}_{user['pk']}", "code": "x", "taken_at": taken_at,
+            "media_type": 2 if video else 1, "product_type": "clips" if video else "feed", "user": user,
+            "image_versions2": {"candidates": [
+                {"url": f"{self.cdn_base}/{pk}.jpg?size={self.photo_size}", "width": 1080, "height": 1350},
+            ]},
+            "caption": {"text": "benchmark #fake"}, "like_count": 0, "comment_count": 0,
+        }
+        if video:
+            item["video_versions"] = [
+                {"url": f"{self.cdn_base}/{pk}.mp4?size={self.video_size}", "width": 720, "height": 1280, "type": 101},
+            ]
+            item["video_duration"] = 15.0
+        return item
+
+    async def _reply(self, data: dict) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        data["status"] = "ok"
+        return web.json_response(data)
+
+    async def media_info(self, request: web.Request) -> web.Response:
+        pk = request.match_info["pk"]
+        if pk not in self.posts:
+            self.requests += 1
+            return web.json_response({"status": "fail", "message": "Media not found or unavailable"}, status=404)
+        kind, items = self.posts[pk]
+        user = self._user("bench")
+        now = int(time.time())
+        if kind == "carousel":
+            media = self._item(pk, False, user, now)
+            media.update(media_type=8, product_type="carousel_container", carousel_media=[
+                self._item(f"{pk}{i:02d}", i % 2 == 1, user, now) for i in range(items)
+            ])
+        else:
+            media = self._item(pk, kind == "reel", user, now)
+        return await self._reply({"items": [media], "num_results": 1})
+
+    async def usernameinfo(self, request: web.Request) -> web.Response:
+        return await self._reply({"user": self._user(request.match_info["username"])})
+
+    async def user_story(self, request: web.Request) -> web.Response:
+        user_id = request.match_info["user_id"]
+        user = {"pk": user_id, "username": f"user{user_id}", "is_private": False,
+                "profile_pic_url": "https://example.invalid/p.jpg"}
+        now = int(time.time())
+        items = [
+            self._item(f"{user_id}{i:03d}", i % 2 == 1, user, now - 3600 + i * 60)
+            for i in range(self.stories_per_user)
+        ]
+        return await self._reply({"reel": {"id": user_id, "items": items}})
+
+    async def unsupported(self, request: web.Request) -> web.Response:
+        # Endpoint public (a1, GQL...) không được giả lập: trả body rỗng như Instagram hay làm
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        return web.Response(text="", content_type="text/html")
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_get("/api/v1/media/{pk}/info/", self.media_info)
+        app.router.add_get("/api/v1/users/{username}/usernameinfo/", self.usernameinfo)
+        app.router.add_get("/api/v1/feed/user/{user_id}/story/", self.user_story)
+        app.router.add_route("*", "/{tail:.*}", self.unsupported)
+        self.runner, self.base = await _serve(app)
+        return self.base
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
+
+
+class _RedirectAdapter(HTTPAdapter):
+    """Đổi scheme + host của request sang server giả, giữ nguyên path và query."""
+
+    def __init__(self, base: str):
+        super().__init__()
+        self.base = base
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        request.url = self.base + parts.path + (f"?{parts.query}" if parts.query else "")
+        return super().send(request, **kwargs)
+
+
+def redirect_instagrapi(client, base: str) -> None:
+    """Cho client instagrapi gọi FakeInstagram thay vì Instagram và coi như đã đăng nhập."""
+    adapter = _RedirectAdapter(base)
+    for session in (client.private, client.public):
+        session.mount("https://i.instagram.com/", adapter)
+        session.mount("https://www.instagram.com/", adapter)
+    client.authorization_data = {"ds_user_id": "1", "sessionid": "1%3Abenchmark%3A1"}
+
+
+class FakeBotAPI:
+    """
+    Bot API giả tại <base>/bot<token>/<method>. Upload được đọc hết (như Telegram nhận file),
+    có thể giới hạn băng thông upload và thêm độ trễ mỗi lời gọi.
+    listeners: hàm (method, data) được gọi với mỗi lời gọi, vd để load test biết job nào đã xong.
+    Media gửi bằng URL được tải về như Telegram làm; quá giới hạn thì trả 400.
+    """
+
+    URL_LIMITS = {"photo": 5 * 1024 ** 2, "video": 20 * 1024 ** 2, "document": 20 * 1024 ** 2}
+
+    def __init__(self, latency: float = 0.02, bandwidth: float = 0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.listeners = []
+        self.calls = {}
+        self.bytes_received = 0
+        self.bytes_fetched = 0
+        self._ids = itertools.count(1000)
+        self.runner = None
+        self.base = None
+
+    def _message(self, chat_id, **extra) -> dict:
+        message = {"message_id": next(self._ids), "date": int(time.time()),
+                   "chat": {"id": int(chat_id), "type": "private"}}
+        message.update(extra)
+        return message
+
+    def _file(self, kind: str) -> dict:
+        file_id = f"{kind}{next(self._ids)}"
+        if kind == "photo":
+            return {"photo": [{"file_id": file_id, "file_unique_id": file_id, "width": 1080, "height": 1350}]}
+        if kind == "video":
+            return {"video": {"file_id": file_id, "file_unique_id": file_id, "width": 720, "height": 1280,
+                              "duration": 15}}
+        return {"document": {"file_id": file_id, "file_unique_id": file_id}}
+
+    async def _read(self, request: web.Request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        if request.content_type != "multipart/form-data":
+            return dict(await request.post())
+        fields = {}
+        reader = await request.multipart()
+        async for part in reader:
+            if part.filename is None:
+                fields[part.name] = await part.text()
+                continue
+            while chunk := await part.read_chunk(64 * 1024):
+                self.bytes_received += len(chunk)
+                if self.bandwidth:
+                    await asyncio.sleep(len(chunk) / self.bandwidth)
+        return fields
+
+    async def _fetch_url(self, kind: str, url) -> str | None:
+        """Tải media từ URL như Telegram; trả về mô tả lỗi nếu không lấy được."""
+        if not isinstance(url, str) or not url.startswith("http"):
+            return None
+        size = 0
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as response:
+                if response.status != 200:
+                    return "Bad Request: wrong file identifier/HTTP URL specified"
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    size += len(chunk)
+                    if size > self.URL_LIMITS[kind]:
+                        return "Bad Request: failed to get HTTP URL content"
+        self.bytes_fetched += size
+        return None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        data = await self._read(request)
+        await asyncio.sleep(self.latency)
+        chat_id = data.get("chat_id", 1)
+        if method in ("sendPhoto", "sendVideo", "sendDocument"):
+            kind = method[4:].lower()
+            error = await self._fetch_url(kind, data.get(kind))
+        elif method == "sendMediaGroup":
+            media = data["media"]
+            media = json.loads(media) if isinstance(media, str) else media
+            errors = [await self._fetch_url(m["type"], m["media"]) for m in media]
+            error = next((e for e in errors if e), None)
+        else:
+            error = None
+        if error:
+            return web.json_response({"ok": False, "error_code": 400, "description": error}, status=400)
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, text=data.get("text", ""))
+        elif method in ("sendPhoto", "sendVideo", "sendDocument"):
+            result = self._message(chat_id, **self._file(method[4:].lower()))
+        elif method == "sendMediaGroup":
+            media = data["media"]
+            media = json.loads(media) if isinstance(media, str) else media
+            result = [self._message(chat_id, **self._file(m["type"])) for m in media]
+        else:
+            result = True
+        for listener in self.listeners:
+            listener(method, data)
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self) -> str:
+        app = web.Application(client_max_size=100 * 1024 ** 2)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner, self.base = await _serve(app)
+        return self.base
+
+    async def stop(self) -> None:
+        await self.runner.cleanup()
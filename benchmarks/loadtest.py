@@ -0,0 +1,440 @@
+"""
+Load test: chạy bot thật (webhook mode, đủ handler, job_queue, cache...) nối với Instagram, CDN
+và Bot API giả, rồi bắn update từ nhiều chat giả lập theo một ramp profile để tìm điểm bot quá tải.
+
+File URL mix là JSONL như requests.jsonl, mỗi dòng một object:
+
+    {"url": "https://www.instagram.com/reel/Cabc123/", "kind": "reel", "weight": 3}
+    {"url": "https://www.instagram.com/p/Cdef456/", "kind": "carousel", "items": 10}
+    {"url": "https://www.instagram.com/stories/someone/"}
+
+Dòng không có "url" thì lấy URL Instagram đầu tiên trong các giá trị chuỗi. "kind" mặc định theo
+đường dẫn (/reel/ -> reel, /p/ -> photo). Cùng URL lặp lại sẽ trúng cache như khi chạy thật.
+
+Profile "rate x giây" cách nhau dấu phẩy, mỗi bước gửi update theo phân phối Poisson:
+
+    python benchmarks/loadtest.py benchmarks/url_mix.jsonl --profile 1x30,2x30,4x30,8x30,16x30
+
+Mỗi bước in throughput, tỉ lệ lỗi, latency, độ sâu hàng đợi, độ trễ event loop của bot;
+cuối cùng in điểm bão hoà (bước đầu tiên bot không theo kịp tải): so số update thật sự gửi trong bước
+với số update đó hoàn thành trước khi bước kết thúc + --step-drain giây, không so với tải danh nghĩa.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fakes  # noqa: E402
+from bench import configure_env as configure_bench_env, percentile  # noqa: E402
+
+URL_PATTERN = re.compile(r"https?://(?:www\.)?instagram\.com/(p|reel|stories|s)/([^/?\s]+)[^\s\"']*")
+
+
+def load_mix(path: str) -> list:
+    """Đọc URL mix -> [(url, kind, items, weight)]."""
+    mix = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            url = entry.get("url")
+            if not url:
+                found = (URL_PATTERN.search(v) for v in entry.values() if isinstance(v, str))
+                match = next(filter(None, found), None)
+                if match is None:
+                    continue
+                url = match.group(0)
+            match = URL_PATTERN.search(url)
+            if match is None:
+                continue
+            kind = entry.get("kind") or {"reel": "reel", "p": "photo"}.get(match.group(1), "story")
+            mix.append((url, kind, int(entry.get("items", 10 if kind == "carousel" else 1)),
+                        float(entry.get("weight", 1))))
+    if not mix:
+        raise SystemExit(f"Không có URL Instagram nào trong {path}")
+    return mix
+
+
+def parse_profile(value: str) -> list:
+    """"1x30,5x60" -> [(1.0, 30.0), (5.0, 60.0)]: (update mỗi giây, số giây)."""
+    steps = []
+    for part in value.split(","):
+        rate, _, duration = part.strip().partition("x")
+        steps.append((float(rate), float(duration)))
+    return steps
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def classify(method: str, text: str) -> str | None:
+    """
+    Kết quả cuối của một job dựa trên tin nhắn bot gửi cho chat (None = chưa xong).
+    Phụ thuộc vào nội dung tin nhắn trong instagrap.py; đổi câu chữ ở đó thì sửa ở đây.
+    """
+    if method == "sendMessage" and text.startswith("🚦"):
+        return "rejected"
+    if method != "editMessageText":
+        return None
+    if text.startswith("✅ Tải xuống"):
+        return "ok"
+    if "tự thử lại" in text:
+        return None  # Job bị hoãn vì rate limit, sẽ tự chạy lại
+    if text.startswith(("❌", "⚠️", "⏳")):
+        return "failed"
+    return None
+
+
+class Request:
+    __slots__ = ("chat_id", "url", "step", "sent_at", "done_at", "outcome")
+
+    def __init__(self, chat_id: int, url: str, step: int, sent_at: float):
+        self.chat_id = chat_id
+        self.url = url
+        self.step = step
+        self.sent_at = sent_at
+        self.done_at = None
+        self.outcome = None
+
+
+class LoadDriver:
+    """
+    Chạy trong thread riêng với event loop riêng: server giả + bộ sinh tải không chiếm event loop
+    của bot, nên độ trễ event loop đo được là của bot.
+    """
+
+    def __init__(self, args, mix: list):
+        self.args = args
+        self.mix = mix
+        self.random = random.Random(args.seed)
+        self.requests = {}  # chat_id -> Request (mỗi request một chat giả lập)
+        self.samples = []  # (thời điểm, độ trễ loop, độ sâu hàng đợi, số job đang chạy) lấy trong loop của bot
+        self.step_windows = []  # (bắt đầu, kết thúc) theo time.monotonic của từng bước
+        self.ready = threading.Event()
+        self._bot_ready = threading.Event()
+        self.bot_loop = None
+        self.ig = None
+        self.webhook_url = None
+        self.cdn = self.instagram = self.bot_api = None
+        self.thread = threading.Thread(target=self._thread_main, name="loadtest", daemon=True)
+        self.report = None
+
+    # --- server giả ---
+
+    async def _start_fakes(self) -> None:
+        args = self.args
+        self.cdn = fakes.FakeCDN(ttfb=args.cdn_ttfb, bandwidth=args.cdn_bandwidth)
+        await self.cdn.start()
+        self.instagram = fakes.FakeInstagram(
+            self.cdn.base, latency=args.instagram_latency, photo_size=args.photo_size,
+            video_size=args.video_size, stories_per_user=args.stories,
+        )
+        await self.instagram.start()
+        self.bot_api = fakes.FakeBotAPI(latency=args.bot_latency, bandwidth=args.upload_bandwidth)
+        self.bot_api.listeners.append(self._on_bot_call)
+        await self.bot_api.start()
+
+    def register_posts(self, media_pk_from_code) -> None:
+        for url, kind, items, _ in self.mix:
+            match = URL_PATTERN.search(url)
+            if match.group(1) in ("p", "reel"):
+                self.instagram.add_post(media_pk_from_code(match.group(2)), kind, items)
+
+    def _on_bot_call(self, method: str, data: dict) -> None:
+        try:
+            request = self.requests.get(int(data.get("chat_id", 0)))
+        except (TypeError, ValueError):
+            return
+        if request is None or request.outcome is not None:
+            return
+        outcome = classify(method, str(data.get("text", "")))
+        if outcome is not None:
+            request.outcome = outcome
+            request.done_at = time.monotonic()
+
+    # --- đo trong event loop của bot ---
+
+    async def _sampler(self) -> None:
+        interval = self.args.sample_interval
+        job_queue = self.ig.job_queue
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            lag = time.monotonic() - started - interval
+            self.samples.append((time.monotonic(), max(0.0, lag), job_queue.stats()["depth"], job_queue.busy))
+
+    # --- sinh tải ---
+
+    def _update(self, request: Request) -> dict:
+        return {
+            "update_id": request.chat_id,
+            "message": {
+                "message_id": 1, "date": int(time.time()), "text": request.url,
+                "chat": {"id": request.chat_id, "type": "private"},
+                "from": {"id": request.chat_id, "is_bot": False, "first_name": "load"},
+            },
+        }
+
+    async def _send(self, session, request: Request) -> None:
+        try:
+            async with session.post(
+                self.webhook_url, json=self._update(request),
+                headers={"X-Telegram-Bot-Api-Secret-Token": self.args.secret},
+            ) as response:
+                if response.status != 200:
+                    raise RuntimeError(f"HTTP {response.status}")
+        except Exception:
+            if request.outcome is None:
+                request.outcome = "webhook_error"
+                request.done_at = time.monotonic()
+
+    async def _wait_webhook(self, session) -> None:
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(self.webhook_url) as response:
+                    if response.status in (200, 405):
+                        return
+            except Exception:
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError("Webhook của bot không khởi động")
+
+    async def _run_load(self) -> None:
+        import aiohttp
+
+        urls = [entry[0] for entry in self.mix]
+        weights = [entry[3] for entry in self.mix]
+        tasks = set()
+        chat_ids = iter(range(10 ** 6, 10 ** 9))
+        async with aiohttp.ClientSession() as session:
+            await self._wait_webhook(session)
+            # Làm nóng tuần tự (media_strategy_stats học nguồn media_info nào dùng được), không tính vào kết quả
+            for _ in range(self.args.warmup):
+                request = Request(next(chat_ids), self.random.choices(urls, weights)[0], -1, time.monotonic())
+                self.requests[request.chat_id] = request
+                await self._send(session, request)
+                deadline = time.monotonic() + self.args.drain_timeout
+                while request.outcome is None and time.monotonic() < deadline:
+                    await asyncio.sleep(0.05)
+            for chat_id in [c for c, r in self.requests.items() if r.step < 0]:
+                del self.requests[chat_id]
+            asyncio.run_coroutine_threadsafe(self._sampler(), self.bot_loop)
+            for step, (rate, duration) in enumerate(parse_profile(self.args.profile)):
+                started = time.monotonic()
+                self.step_windows.append((started, started + duration))
+                print(f"Bước {step + 1}: {rate:g} update/s trong {duration:g}s", file=sys.stderr)
+                next_at = started
+                while True:
+                    next_at += (self.random.expovariate(rate) if self.args.arrival == "poisson" else 1 / rate)
+                    if next_at >= started + duration:
+                        break
+                    await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+                    chat_id = next(chat_ids)
+                    request = Request(chat_id, self.random.choices(urls, weights)[0], step, time.monotonic())
+                    self.requests[chat_id] = request
+                    task = asyncio.ensure_future(self._send(session, request))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                await asyncio.sleep(max(0.0, started + duration - time.monotonic()))
+            # Chờ các job còn lại xong (hoặc quá hạn)
+            deadline = time.monotonic() + self.args.drain_timeout
+            while time.monotonic() < deadline and any(r.outcome is None for r in self.requests.values()):
+                await asyncio.sleep(0.2)
+            for request in self.requests.values():
+                if request.outcome is None:
+                    request.outcome = "timeout"
+
+    # --- báo cáo ---
+
+    def _step_report(self, step: int, rate: float, window: tuple) -> dict:
+        start, end = window
+        sent = [r for r in self.requests.values() if r.step == step]
+        # Update của bước này xong kịp (cho phép hoàn thành trễ step_drain giây sau khi bước kết thúc)
+        completed = [r for r in sent if r.outcome == "ok" and r.done_at < end + self.args.step_drain]
+        errors = [r for r in sent if r.outcome != "ok"]
+        latencies = [r.done_at - r.sent_at for r in sent if r.outcome == "ok"]
+        samples = [s for s in self.samples if start <= s[0] < end]
+        lags = [s[1] for s in samples]
+        depths = [s[2] for s in samples]
+        duration = end - start
+        return {
+            "step": step + 1, "offered": rate, "sent": len(sent), "completed": len(completed),
+            "throughput": len(completed) / duration if duration else 0.0,
+            "error_rate": len(errors) / len(sent) if sent else 0.0,
+            "p50": percentile(latencies, 0.5), "p95": percentile(latencies, 0.95),
+            "queue_start": depths[0] if depths else 0, "queue_end": depths[-1] if depths else 0,
+            "queue_max": max(depths, default=0),
+            "lag_p95": percentile(lags, 0.95), "lag_max": max(lags, default=0.0),
+            "busy_max": max((s[3] for s in samples), default=0),
+        }
+
+    def build_report(self) -> dict:
+        steps = [
+            self._step_report(i, rate, window)
+            for i, ((rate, _), window) in enumerate(zip(parse_profile(self.args.profile), self.step_windows))
+        ]
+        saturation = None
+        for s in steps:
+            # Không theo kịp: xong kịp ít hơn 90% update đã gửi, lỗi > 5%, hoặc hàng đợi dồn lên trong bước
+            queue_growth = s["queue_end"] - s["queue_start"]
+            if (s["completed"] < 0.9 * s["sent"] or s["error_rate"] > 0.05
+                    or queue_growth > max(1.0, 0.1 * s["sent"])):
+                saturation = s
+                break
+        outcomes = {}
+        for request in self.requests.values():
+            outcomes[request.outcome] = outcomes.get(request.outcome, 0) + 1
+        total = len(self.requests)
+        return {
+            "steps": steps, "outcomes": outcomes, "total": total,
+            "error_rate": (total - outcomes.get("ok", 0)) / total if total else 0.0,
+            "saturation": saturation,
+            "instagram_requests": self.instagram.requests, "cdn_requests": self.cdn.requests,
+            "bot_api_calls": self.bot_api.calls, "uploaded_bytes": self.bot_api.bytes_received,
+        }
+
+    # --- thread ---
+
+    def _thread_main(self) -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self._start_fakes())
+        self.ready.set()
+        try:
+            self._bot_ready.wait()
+            loop.run_until_complete(self._run_load())
+            self.report = self.build_report()
+        finally:
+            # Dừng bot như khi nhận SIGTERM (run_webhook tự dọn dẹp)
+            os.kill(os.getpid(), signal.SIGTERM)
+            for server in (self.bot_api, self.instagram, self.cdn):
+                loop.run_until_complete(server.stop())
+            loop.close()
+
+    def start(self) -> None:
+        self.thread.start()
+        self.ready.wait()
+
+    def attach_bot(self, ig, bot_loop, webhook_url: str) -> None:
+        self.ig = ig
+        self.bot_loop = bot_loop
+        self.webhook_url = webhook_url
+        self._bot_ready.set()
+
+
+def print_report(report: dict) -> None:
+    header = (f"{'bước':>4} {'tải/s':>7} {'gửi':>5} {'xong':>5} {'xong/s':>7} {'lỗi %':>6} {'p50 s':>7} {'p95 s':>7} "
+              f"{'queue đầu→cuối (max)':>21} {'lag p95 ms':>10} {'lag max ms':>10} {'worker':>6}")
+    print(header)
+    print("-" * len(header))
+    for s in report["steps"]:
+        queue = f"{s['queue_start']}→{s['queue_end']} ({s['queue_max']})"
+        print(
+            f"{s['step']:>4} {s['offered']:>7g} {s['sent']:>5} {s['completed']:>5} {s['throughput']:>7.2f} "
+            f"{s['error_rate'] * 100:>6.1f} {s['p50']:>7.2f} {s['p95']:>7.2f} {queue:>21} "
+            f"{s['lag_p95'] * 1000:>10.1f} {s['lag_max'] * 1000:>10.1f} {s['busy_max']:>6}"
+        )
+    print()
+    print(f"Tổng {report['total']} request, tỉ lệ lỗi {report['error_rate'] * 100:.1f}%, kết quả: {report['outcomes']}")
+    print(f"Instagram giả: {report['instagram_requests']} request, CDN giả: {report['cdn_requests']} request, "
+          f"upload: {report['uploaded_bytes'] / 1024 ** 2:.1f} MB")
+    saturation = report["saturation"]
+    if saturation is None:
+        print("Chưa bão hoà: bot theo kịp mọi bước của profile")
+    else:
+        print(f"Điểm bão hoà: ~{saturation['offered']:g} update/s (bước {saturation['step']})")
+
+
+def configure_env(args, driver: LoadDriver, webhook_port: int) -> None:
+    # Giới hạn tốc độ giữ như khi chạy thật, trừ khi --unthrottled
+    configure_bench_env("loadtest", unthrottled=args.unthrottled)
+    os.environ.update(
+        BOT_MODE="webhook", WEBHOOK_LISTEN="127.0.0.1", WEBHOOK_PORT=str(webhook_port),
+        WEBHOOK_URL=f"http://127.0.0.1:{webhook_port}", WEBHOOK_SECRET=args.secret,
+        TELEGRAM_API_BASE_URL=driver.bot_api.base + "/bot",
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mix", help="file JSONL chứa URL mix")
+    parser.add_argument("--profile", default="1x20,2x20,4x20,8x20,16x20", help='"update/s x giây", vd 1x30,5x30')
+    parser.add_argument("--arrival", choices=["poisson", "uniform"], default="poisson")
+    parser.add_argument("--unthrottled", action="store_true",
+                        help="bỏ giới hạn tốc độ Instagram/CDN/chat để đo giới hạn của chính bot")
+    parser.add_argument("--warmup", type=int, default=5, help="số update gửi tuần tự để làm nóng trước khi đo")
+    parser.add_argument("--drain-timeout", type=float, default=120, help="giây chờ các job còn lại sau bước cuối")
+    parser.add_argument("--step-drain", type=float, default=10,
+                        help="giây cho update của một bước hoàn thành sau khi bước kết thúc mà vẫn tính là theo kịp")
+    parser.add_argument("--sample-interval", type=float, default=0.1, help="chu kỳ đo độ trễ event loop (giây)")
+    parser.add_argument("--instagram-latency", type=float, default=0.1)
+    parser.add_argument("--cdn-ttfb", type=float, default=0.02)
+    parser.add_argument("--cdn-bandwidth", type=float, default=0)
+    parser.add_argument("--bot-latency", type=float, default=0.02)
+    parser.add_argument("--upload-bandwidth", type=float, default=0)
+    parser.add_argument("--photo-size", type=int, default=300_000)
+    parser.add_argument("--video-size", type=int, default=3_000_000)
+    parser.add_argument("--stories", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--secret", default="loadtest-secret")
+    parser.add_argument("--json", help="ghi báo cáo dạng JSON ra file này")
+    parser.add_argument("--log-level", default="WARNING")
+    return parser.parse_args(argv)
+
+
+def main(args) -> None:
+    mix = load_mix(args.mix)
+    driver = LoadDriver(args, mix)
+    driver.start()
+    webhook_port = free_port()
+    configure_env(args, driver, webhook_port)
+
+    import logging
+
+    import instagrap as ig
+    logging.getLogger().setLevel(args.log_level)
+    for name in ("public_request", "private_request", "httpx"):
+        logging.getLogger(name).setLevel(logging.CRITICAL)
+    for account in ig.client_pool.accounts:
+        fakes.redirect_instagrapi(account.client, driver.instagram.base)
+    # Client đã "đăng nhập" sẵn với Instagram giả
+    ig.init_instagram_client = lambda: True
+    driver.register_posts(ig.cl.media_pk_from_code)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    driver.attach_bot(ig, loop, f"http://127.0.0.1:{webhook_port}{ig.Config.WEBHOOK_PATH}")
+    loop.run_until_complete(ig.main())
+    driver.thread.join()
+    if driver.report is None:
+        raise SystemExit("Load test dừng giữa chừng")
+    print_report(driver.report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(driver.report, f, ensure_ascii=False, indent=1)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.mix = os.path.abspath(args.mix)
+    args.json = args.json and os.path.abspath(args.json)
+    # instagram_downloads/ nằm trong thư mục tạm, không đụng vào thư mục bot
+    with tempfile.TemporaryDirectory(prefix="instagrap-load-") as workdir:
+        os.chdir(workdir)
+        main(args)
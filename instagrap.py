@@ -1,28 +1,41 @@
 import os
 import logging
-import requests
 import re
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaVideo, Chat, Message
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
 import json
+import sqlite3
 import asyncio
 import aiohttp
-from urllib.parse import urlparse
-import tempfile
-import glob
-import shutil
+from aiohttp import web
+import signal
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime
 import time
+import functools
+import hashlib
+import mimetypes
+import contextvars
+from contextlib import ExitStack
+from collections import deque
+from dataclasses import dataclass, field
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from instagrapi import Client
 from instagrapi import config as ig_config
 from instagrapi.exceptions import (
+    ChallengeError,
     ClientJSONDecodeError,
     ClientNotFoundError,
+    FeedbackRequired,
     LoginRequired,
     MediaNotFound,
+    PleaseWaitFewMinutes,
+    RateLimitError,
 )
+from contextlib import asynccontextmanager, contextmanager
 from dotenv import load_dotenv
-import random
-import time 
 
 # Load environment variables
 load_dotenv()
@@ -40,6 +53,96 @@ class Config:
     INSTAGRAM_USERNAME = os.getenv('INSTAGRAM_USERNAME')
     INSTAGRAM_PASSWORD = os.getenv('INSTAGRAM_PASSWORD')
     DOWNLOAD_DIR = "instagram_downloads"
+    # Số thread tối đa chạy song song các lời gọi instagrapi (đồng bộ, chặn)
+    IG_EXECUTOR_WORKERS = int(os.getenv('IG_EXECUTOR_WORKERS', '4'))
+    # SQLite lưu file_id Telegram của các media đã gửi
+    FILE_ID_CACHE_PATH = os.getenv('FILE_ID_CACHE_PATH', 'file_id_cache.sqlite3')
+    # Connection pool dùng chung cho mọi lượt tải từ CDN
+    HTTP_POOL_LIMIT = int(os.getenv('HTTP_POOL_LIMIT', '100'))
+    HTTP_POOL_LIMIT_PER_HOST = int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', '10'))
+    HTTP_DNS_CACHE_TTL = int(os.getenv('HTTP_DNS_CACHE_TTL', '300'))
+    HTTP_KEEPALIVE_TIMEOUT = float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', '30'))
+    # Kích thước mỗi chunk khi ghi file tải từ CDN (byte)
+    DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', str(256 * 1024)))
+    # Số item carousel tải song song trong một bài viết / tổng số lượt tải CDN đồng thời
+    CAROUSEL_CONCURRENCY = int(os.getenv('CAROUSEL_CONCURRENCY', '4'))
+    CDN_MAX_CONCURRENT_DOWNLOADS = int(os.getenv('CDN_MAX_CONCURRENT_DOWNLOADS', '16'))
+    # Số story tải song song trong một lượt / thời gian tối đa mỗi lượt tải một story (giây)
+    STORY_CONCURRENCY = int(os.getenv('STORY_CONCURRENCY', '4'))
+    STORY_DOWNLOAD_TIMEOUT = int(os.getenv('STORY_DOWNLOAD_TIMEOUT', '60'))
+    # Cách gửi media về Telegram: "document" (mặc định, từng file) hoặc "media_group" (gom album)
+    TELEGRAM_DELIVERY_MODE = os.getenv('TELEGRAM_DELIVERY_MODE', 'document')
+    # Pipe: reel được stream từ CDN thẳng vào upload Bot API, không ghi đĩa; buffer tối đa N chunk
+    TELEGRAM_PIPE_MODE = os.getenv('TELEGRAM_PIPE_MODE', 'false').lower() in ('1', 'true', 'yes')
+    TELEGRAM_PIPE_BUFFER_CHUNKS = int(os.getenv('TELEGRAM_PIPE_BUFFER_CHUNKS', '4'))
+    # Gửi URL CDN cho Telegram tự tải (ảnh ≤ 5MB, file khác ≤ 20MB); bị từ chối mới tải về và upload
+    TELEGRAM_SEND_BY_URL = os.getenv('TELEGRAM_SEND_BY_URL', 'false').lower() in ('1', 'true', 'yes')
+    # Token bucket cho từng nhóm endpoint Instagram: "số request mỗi giây,burst"
+    RATE_LIMIT_LOGIN = os.getenv('RATE_LIMIT_LOGIN', '0.05,1')
+    RATE_LIMIT_MEDIA_INFO = os.getenv('RATE_LIMIT_MEDIA_INFO', '0.5,5')
+    RATE_LIMIT_STORIES = os.getenv('RATE_LIMIT_STORIES', '0.5,5')
+    RATE_LIMIT_CDN = os.getenv('RATE_LIMIT_CDN', '20,40')
+    # Tài khoản Instagram bổ sung cho pool: "user2:pass2,user3:pass3"
+    INSTAGRAM_EXTRA_ACCOUNTS = os.getenv('INSTAGRAM_EXTRA_ACCOUNTS', '')
+    # Thời gian tạm nghỉ một tài khoản khi Instagram báo rate limit (giây)
+    ACCOUNT_COOLDOWN_SECONDS = int(os.getenv('ACCOUNT_COOLDOWN_SECONDS', '300'))
+    # SQLite (WAL) lưu media_info dạng gọn; TTL theo thời điểm hết hạn của URL CDN
+    MEDIA_META_CACHE_PATH = os.getenv('MEDIA_META_CACHE_PATH', 'media_meta_cache.sqlite3')
+    MEDIA_META_DEFAULT_TTL = int(os.getenv('MEDIA_META_DEFAULT_TTL', '3600'))
+    MEDIA_META_EXPIRY_MARGIN = int(os.getenv('MEDIA_META_EXPIRY_MARGIN', '300'))
+    # Cache media trên đĩa, lưu theo nội dung (sha256) trong thư mục chia shard; 0 byte = tắt
+    MEDIA_CACHE_DIR = os.getenv('MEDIA_CACHE_DIR', 'media_cache')
+    MEDIA_CACHE_MAX_BYTES = int(os.getenv('MEDIA_CACHE_MAX_BYTES', str(1024 ** 3)))
+    # Thống kê cuộn của các nguồn media_info: số lần gần nhất, số lỗi liên tiếp trước khi tạm bỏ qua, thời gian bỏ qua (giây)
+    MEDIA_STRATEGY_WINDOW = int(os.getenv('MEDIA_STRATEGY_WINDOW', '50'))
+    MEDIA_STRATEGY_FAILURE_THRESHOLD = int(os.getenv('MEDIA_STRATEGY_FAILURE_THRESHOLD', '3'))
+    MEDIA_STRATEGY_COOLOFF = int(os.getenv('MEDIA_STRATEGY_COOLOFF', '120'))
+    # Hedge media_info: nguồn đầu chưa trả lời sau ngưỡng (percentile latency) thì chạy song song nguồn kế tiếp
+    MEDIA_HEDGE_ENABLED = os.getenv('MEDIA_HEDGE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+    MEDIA_HEDGE_PERCENTILE = float(os.getenv('MEDIA_HEDGE_PERCENTILE', '0.95'))
+    MEDIA_HEDGE_MIN_DELAY = float(os.getenv('MEDIA_HEDGE_MIN_DELAY', '1'))
+    MEDIA_HEDGE_DEFAULT_DELAY = float(os.getenv('MEDIA_HEDGE_DEFAULT_DELAY', '5'))
+    # Số request hedge tối đa so với request chính (0.1 = thêm tối đa 10% tải)
+    MEDIA_HEDGE_MAX_RATIO = float(os.getenv('MEDIA_HEDGE_MAX_RATIO', '0.1'))
+    # Circuit breaker theo nhóm endpoint: số lỗi liên tiếp để mở, thời gian mở trước khi cho request thử (giây)
+    CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+    CIRCUIT_RESET_TIMEOUT = int(os.getenv('CIRCUIT_RESET_TIMEOUT', '60'))
+    # Số lần retry tối đa so với số lần gọi đầu tiên, tính chung cả bot (0.2 = 20%)
+    RETRY_BUDGET_RATIO = float(os.getenv('RETRY_BUDGET_RATIO', '0.2'))
+    # Số lần tối đa một job bị rate limit được hoãn rồi chạy lại
+    DEFERRED_RETRY_MAX_ATTEMPTS = int(os.getenv('DEFERRED_RETRY_MAX_ATTEMPTS', '3'))
+    # CDN trả 429 (hoặc 503 kèm Retry-After) mà không nói chờ bao lâu: hoãn job bấy nhiêu giây
+    CDN_RETRY_AFTER = int(os.getenv('CDN_RETRY_AFTER', '60'))
+    # Số worker xử lý URL song song / số job chờ tối đa trong hàng đợi (0: không giới hạn)
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', '8'))
+    JOB_QUEUE_MAX = int(os.getenv('JOB_QUEUE_MAX', '200'))
+    # Chia lượt công bằng giữa các chat: số job chạy đồng thời tối đa của một chat, quota "link mỗi giây,burst"
+    USER_MAX_IN_FLIGHT = int(os.getenv('USER_MAX_IN_FLIGHT', '2'))
+    USER_RATE_LIMIT = os.getenv('USER_RATE_LIMIT', '0.1,10')
+    # Chat ưu tiên ("id1,id2") được trọng số cao hơn khi chia lượt
+    PRIORITY_CHAT_IDS = {int(i) for i in os.getenv('PRIORITY_CHAT_IDS', '').split(',') if i.strip()}
+    PRIORITY_CHAT_WEIGHT = int(os.getenv('PRIORITY_CHAT_WEIGHT', '3'))
+    # Cách nhận update: "polling" (mặc định) hoặc "webhook" (server aiohttp nhúng)
+    BOT_MODE = os.getenv('BOT_MODE', 'polling')
+    WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+    WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+    WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+    # URL công khai (HTTPS) mà Telegram gọi tới, không gồm path, vd: https://bot.example.com
+    WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+    WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+    WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+    # Bot API server khác api.telegram.org (local Bot API server, server giả khi test), vd: http://127.0.0.1:8081/bot
+    TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL', '')
+    # Endpoint Prometheus /metrics (tắt mặc định: METRICS_PORT=0)
+    METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+    METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+    # Tracing theo request: file JSONL, endpoint OTLP HTTP/JSON (vd: http://127.0.0.1:4318/v1/traces),
+    # ngưỡng (giây) để log cả cây span của request chậm (0 = tắt)
+    TRACE_PATH = os.getenv('TRACE_PATH', '')
+    TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT', '')
+    TRACE_SLOW_SECONDS = float(os.getenv('TRACE_SLOW_SECONDS', '60'))
+    # Telegram user ID được dùng lệnh /stats: "123,456"
+    ADMIN_USER_IDS = {int(i) for i in os.getenv('ADMIN_USER_IDS', '').split(',') if i.strip()}
     
     @classmethod
     def validate(cls):
@@ -50,6 +153,8 @@ class Config:
             missing.append('INSTAGRAM_USERNAME')
         if not cls.INSTAGRAM_PASSWORD:
             missing.append('INSTAGRAM_PASSWORD')
+        if cls.BOT_MODE == 'webhook' and not cls.WEBHOOK_URL:
+            missing.append('WEBHOOK_URL')
         
         if missing:
             raise ValueError(f"Missing required environment variables: {', '.join(missing)}\n"
@@ -66,6 +171,340 @@ DOWNLOAD_DIR = Config.DOWNLOAD_DIR
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
 
+def _format_labels(labels: tuple, extra: str = "") -> str:
+    parts = [
+        '{0}="{1}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    ]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    """Counter kiểu Prometheus, có label; thread-safe vì được tăng cả từ thread instagrapi."""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    """Histogram kiểu Prometheus (bucket tích luỹ, _sum, _count), có label."""
+
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, name: str, help_text: str, buckets: tuple = BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self._values = {}  # labels -> [bucket counts, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            # Bucket tích luỹ, ô cuối là +Inf (= count); sum lưu riêng
+            data = self._values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[0][i] += 1
+            data[0][-1] += 1
+            data[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, data in self._values.items():
+                counts, total = data
+                for bound, count in zip((*self.buckets, "+Inf"), counts):
+                    le = 'le="{0}"'.format(bound)
+                    lines.append(f"{self.name}_bucket{_format_labels(key, le)} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {counts[-1]}")
+        return lines
+
+
+class Gauge:
+    """
+    Gauge đọc giá trị lúc scrape từ một hàm. blocking: hàm chặn (vd os.walk), được gọi trong thread;
+    các gauge khác đọc state của event loop nên chỉ được đọc trên loop.
+    """
+
+    def __init__(self, name: str, help_text: str, read, blocking: bool = False):
+        self.name = name
+        self.help = help_text
+        self.read = read
+        self.blocking = blocking
+
+    def render(self, value=None) -> list:
+        value = self.read() if value is None else value
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class Metrics:
+    """Các metric của pipeline tải; xuất dạng text Prometheus qua /metrics."""
+
+    def __init__(self):
+        self.stage_seconds = Histogram(
+            "instagrap_stage_seconds", "Thời gian từng bước xử lý (url_parse, media_info, cdn_download, telegram_upload, end_to_end)"
+        )
+        self.media_info_seconds = Histogram(
+            "instagrap_media_info_seconds", "Thời gian mỗi lần thử một nguồn media_info"
+        )
+        self.rate_limits = Counter("instagrap_rate_limit_total", "Số lần Instagram báo rate limit")
+        self.relogins = Counter("instagrap_relogin_total", "Số lần đăng nhập lại do LoginRequired")
+        self.json_retries = Counter("instagrap_json_decode_retries_total", "Số vòng retry media_info do JSON rỗng/lỗi")
+        self.downloaded_bytes = Counter("instagrap_downloaded_bytes_total", "Số byte tải từ CDN")
+        self.uploaded_bytes = Counter("instagrap_uploaded_bytes_total", "Số byte upload lên Telegram")
+        self.jobs = Counter("instagrap_jobs_total", "Số job đã xử lý theo kết quả")
+        self.gauges = []
+
+    def gauge(self, name: str, help_text: str, read, blocking: bool = False) -> None:
+        self.gauges.append(Gauge(name, help_text, read, blocking))
+
+    def render(self, blocking_values: dict | None = None) -> str:
+        """Gọi trên event loop; blocking_values: giá trị đã đọc sẵn (trong thread) của các gauge blocking."""
+        blocking_values = blocking_values or {}
+        lines = []
+        for metric in (self.stage_seconds, self.media_info_seconds, self.rate_limits, self.relogins,
+                       self.json_retries, self.downloaded_bytes, self.uploaded_bytes, self.jobs):
+            lines.extend(metric.render())
+        for gauge in self.gauges:
+            lines.extend(gauge.render(blocking_values.get(gauge.name)))
+        return "\n".join(lines) + "\n"
+
+    async def render_async(self) -> str:
+        """Chỉ các gauge blocking chạy trong thread; phần còn lại đọc trên loop, không tranh state với loop."""
+        loop = asyncio.get_running_loop()
+        blocking_values = {}
+        for gauge in self.gauges:
+            if gauge.blocking:
+                blocking_values[gauge.name] = await loop.run_in_executor(None, gauge.read)
+        return self.render(blocking_values)
+
+
+metrics = Metrics()
+metrics.gauge("instagrap_download_dir_bytes", "Dung lượng thư mục instagram_downloads", lambda: _dir_size(DOWNLOAD_DIR), blocking=True)
+metrics.gauge("instagrap_media_cache_bytes", "Dung lượng cache media trên đĩa", lambda: media_disk_cache.total_bytes if media_disk_cache.enabled else 0)
+
+
+_current_span = contextvars.ContextVar("instagrap_span", default=None)
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+@dataclass
+class Span:
+    """Một bước xử lý của request; các span cùng trace_id (request ID) tạo thành cây."""
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    start: float  # epoch, giây
+    attrs: dict = field(default_factory=dict)
+    end: float | None = None
+    error: str | None = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.time()) - self.start
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id,
+            "name": self.name, "start": self.start, "duration_ms": round(self.duration * 1000, 3),
+            "attrs": self.attrs, "error": self.error,
+        }
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id, "spanId": self.span_id, "name": self.name, "kind": 1,
+            "startTimeUnixNano": str(int(self.start * 1e9)),
+            "endTimeUnixNano": str(int((self.end or time.time()) * 1e9)),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in self.attrs.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class Tracer:
+    """
+    Tracing nhẹ theo request: span gốc cho mỗi update, span con cho từng bước và từng lần thử
+    nguồn media_info. Span đang mở đi theo contextvars nên task con (hedge, singleflight) tự nối vào cây.
+    Trace xong được ghi JSONL / gửi OTLP HTTP; trace lâu hơn ngưỡng thì log cả cây span.
+    """
+
+    def __init__(self, path: str, otlp_endpoint: str, slow_seconds: float):
+        self.path = path
+        self.otlp_endpoint = otlp_endpoint
+        self.slow_seconds = slow_seconds
+        self._traces = {}  # trace_id -> các span con đã xong, chờ span gốc kết thúc
+        self._exports = set()
+        self.finished = 0
+        self.slow = 0
+        self.export_errors = 0
+
+    def start(self, name: str, root: bool = False, **attrs) -> Span:
+        """Mở span con của span hiện tại; không có span hiện tại (hoặc root=True) thì mở trace mới."""
+        parent = None if root else _current_span.get()
+        if parent is None:
+            span = Span(name, os.urandom(16).hex(), os.urandom(8).hex(), None, time.time(), attrs)
+            self._traces[span.trace_id] = []
+        else:
+            span = Span(name, parent.trace_id, os.urandom(8).hex(), parent.span_id, time.time(), attrs)
+        return span
+
+    def finish(self, span: Span, error: BaseException | None = None) -> None:
+        span.end = time.time()
+        if isinstance(error, asyncio.CancelledError):
+            span.error = "cancelled"
+        elif error is not None:
+            span.error = f"{type(error).__name__}: {error}"
+        if span.parent_id is None:
+            spans = self._traces.pop(span.trace_id, [])
+            spans.append(span)
+            self.finished += 1
+            self._export(spans)
+            if self.slow_seconds and span.duration >= self.slow_seconds:
+                self.slow += 1
+                logger.warning(
+                    f"Request chậm {span.duration:.1f}s (req={span.trace_id}):\n" + self.render_tree(spans)
+                )
+        elif span.trace_id in self._traces:
+            self._traces[span.trace_id].append(span)
+        else:
+            # Span kết thúc sau span gốc (vd: nguồn hedge thua bị huỷ muộn): xuất riêng
+            self._export([span])
+
+    def record(self, name: str, seconds: float, **attrs) -> None:
+        """Ghi một span đã xong, kéo dài seconds giây tính tới hiện tại (vd: thời gian chờ hàng đợi)."""
+        span = self.start(name, **attrs)
+        span.start -= seconds
+        self.finish(span)
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        span = self.start(name, **attrs)
+        token = _current_span.set(span)
+        error = None
+        try:
+            yield span
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            _current_span.reset(token)
+            self.finish(span, error)
+
+    def attach(self, span: Span | None):
+        """Đặt span làm span hiện tại của task (span gốc được mang theo job sang worker)."""
+        return _current_span.set(span)
+
+    def detach(self, token) -> None:
+        _current_span.reset(token)
+
+    @staticmethod
+    def render_tree(spans: list) -> str:
+        children = {}
+        for span in spans:
+            children.setdefault(span.parent_id, []).append(span)
+        span_ids = {span.span_id for span in spans}
+        lines = []
+
+        def walk(span: Span, depth: int) -> None:
+            attrs = " ".join(f"{k}={v}" for k, v in span.attrs.items())
+            error = f" ✗ {span.error}" if span.error else ""
+            lines.append(f"{'  ' * depth}{span.name} {span.duration * 1000:.0f}ms {attrs}".rstrip() + error)
+            for child in sorted(children.get(span.span_id, []), key=lambda s: s.start):
+                walk(child, depth + 1)
+
+        for span in sorted((s for s in spans if s.parent_id not in span_ids), key=lambda s: s.start):
+            walk(span, 0)
+        return "\n".join(lines)
+
+    def _export(self, spans: list) -> None:
+        if self.path:
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    for span in spans:
+                        f.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n")
+            except OSError as e:
+                self.export_errors += 1
+                logger.warning(f"Không ghi được trace vào {self.path}: {e}")
+        if self.otlp_endpoint:
+            task = asyncio.ensure_future(self._post_otlp(spans))
+            self._exports.add(task)
+            task.add_done_callback(self._exports.discard)
+
+    async def _post_otlp(self, spans: list) -> None:
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "instagrap"}}]},
+            "scopeSpans": [{"scope": {"name": "instagrap"}, "spans": [span.to_otlp() for span in spans]}],
+        }]}
+        try:
+            async with get_http_session().post(
+                self.otlp_endpoint, json=payload, timeout=aiohttp.ClientTimeout(total=5)
+            ) as response:
+                if response.status >= 300:
+                    raise Exception(f"HTTP {response.status}")
+        except Exception as e:
+            self.export_errors += 1
+            logger.debug(f"Không gửi được trace OTLP: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "open": len(self._traces), "finished": self.finished, "slow": self.slow,
+            "export_errors": self.export_errors,
+        }
+
+
+tracer = Tracer(Config.TRACE_PATH, Config.TRACE_OTLP_ENDPOINT, Config.TRACE_SLOW_SECONDS)
+
+
 class InstagramBotClient(Client):
     """
     Bỏ qua login_flow() mặc định (reels_tray + timeline) — Instagram thường trả 400
@@ -76,9 +515,1130 @@ class InstagramBotClient(Client):
         return True
 
 
-# Instagram client (timeout mặc định 1s của instagrapi dễ body không đủ → JSON lỗi)
-cl = InstagramBotClient(request_timeout=30)
-cl.delay_range = [2, 5]  # Delay giữa các request
+class InstagramExecutor:
+    """
+    Thread pool riêng cho mọi lời gọi instagrapi: các hàm của instagrapi chặn vài giây mỗi lần,
+    chạy thẳng trong handler sẽ đóng băng cả event loop của python-telegram-bot.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="instagrapi")
+        self._lock = threading.Lock()
+        self.queued = 0  # Đã gửi vào pool nhưng chưa có thread nhận
+        self.running = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def run(self, fn, *args, **kwargs):
+        """Chạy fn(*args, **kwargs) trên pool và chờ kết quả mà không chặn event loop."""
+        submitted = time.monotonic()
+
+        def _job():
+            wait = time.monotonic() - submitted
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        with self._lock:
+            self.queued += 1
+        future = self._pool.submit(_job)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # Job chưa kịp chạy thì huỷ luôn để không chiếm chỗ trong hàng đợi
+            if future.cancel():
+                with self._lock:
+                    self.queued -= 1
+            raise
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "avg_wait": self.total_wait / self.completed if self.completed else 0.0,
+                "max_wait": self.max_wait,
+            }
+
+    def shutdown(self, wait: bool = False) -> None:
+        self._pool.shutdown(wait=wait, cancel_futures=True)
+
+
+ig_executor = InstagramExecutor(Config.IG_EXECUTOR_WORKERS)
+
+
+async def ig_call(fn, *args, **kwargs):
+    """Mọi lời gọi instagrapi từ code async phải đi qua đây; lời gọi tới Client dùng InstagramAccount.call để giữ khoá."""
+    return await ig_executor.run(fn, *args, **kwargs)
+
+
+class TokenBucket:
+    """
+    Token bucket thread-safe. Token được đặt trước (có thể âm) nên các bên chờ được phục vụ
+    theo thứ tự; chỉ phải chờ khi bucket thật sự hết token.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.waited = 0
+        self.total_wait = 0.0
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """Lấy token, trả về số giây cần chờ trước khi được dùng (0 nếu còn sẵn)."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            self.acquired += 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            if wait > 0:
+                self.waited += 1
+                self.total_wait += wait
+            return wait
+
+    def try_reserve(self, tokens: float = 1.0) -> float:
+        """Lấy token nếu còn đủ (trả về 0); nếu không thì không lấy, trả về số giây tới khi đủ."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < tokens:
+                return (tokens - self._tokens) / self.rate
+            self._tokens -= tokens
+            self.acquired += 1
+            return 0.0
+
+    def full(self) -> bool:
+        """Bucket đã hồi đầy token: bỏ đi rồi tạo lại cũng không khác gì."""
+        with self._lock:
+            return self._tokens + (time.monotonic() - self._updated) * self.rate >= self.burst
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self, tokens: float = 1.0) -> None:
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+
+def _parse_rate(value: str) -> tuple:
+    """Chuỗi "0.5,5" -> (0.5 request/giây, burst 5)."""
+    rate, _, burst = value.partition(",")
+    return float(rate), float(burst or 1)
+
+
+class RateLimiter:
+    """Một token bucket cho mỗi nhóm endpoint: login, media_info, stories, cdn."""
+
+    def __init__(self, limits: dict):
+        self.buckets = {name: TokenBucket(*_parse_rate(value)) for name, value in limits.items()}
+
+    async def acquire(self, name: str) -> None:
+        wait = self.buckets[name].reserve()
+        if wait > 0:
+            with tracer.span("rate_limit_wait", bucket=name, seconds=round(wait, 3)):
+                await asyncio.sleep(wait)
+
+    def acquire_sync(self, name: str) -> None:
+        self.buckets[name].acquire_sync()
+
+    def stats(self) -> dict:
+        return {
+            name: {"rate": b.rate, "burst": b.burst, "acquired": b.acquired,
+                   "waited": b.waited, "total_wait": b.total_wait}
+            for name, b in self.buckets.items()
+        }
+
+
+# CDN dùng chung cho cả bot; login / media_info / stories tính riêng theo từng tài khoản
+rate_limiter = RateLimiter({"cdn": Config.RATE_LIMIT_CDN})
+
+
+def _is_rate_limit_error(error: Exception) -> bool:
+    if isinstance(error, (PleaseWaitFewMinutes, RateLimitError, FeedbackRequired)):
+        return True
+    return "Please wait a few minutes before you try again" in str(error)
+
+
+def _is_cdn_throttled(error: Exception) -> bool:
+    return isinstance(error, CdnStatusError) and error.retry_after is not None
+
+
+def _is_challenge_error(error: Exception) -> bool:
+    return isinstance(error, ChallengeError) or "challenge_required" in str(error)
+
+
+class AccountsUnavailable(Exception):
+    """Không còn tài khoản Instagram nào sẵn sàng (đang tạm nghỉ hoặc đã bị loại)."""
+
+    def __init__(self, retry_after: float | None):
+        self.retry_after = retry_after
+        if retry_after is None:
+            super().__init__("Không còn tài khoản Instagram nào hoạt động")
+        else:
+            super().__init__(f"Mọi tài khoản Instagram đang tạm nghỉ, thử lại sau {int(retry_after)} giây")
+
+
+class CircuitOpenError(Exception):
+    """Circuit breaker của một nhóm endpoint đang mở: từ chối ngay, không gọi ra ngoài."""
+
+    def __init__(self, name: str, retry_after: float):
+        self.name = name
+        self.retry_after = retry_after
+        super().__init__(
+            f"Instagram đang gặp sự cố ({name}), bot tạm ngừng gửi yêu cầu; "
+            f"thử lại sau {max(1, int(retry_after))} giây"
+        )
+
+
+class RetryLater(Exception):
+    """
+    Instagram giới hạn truy cập: job cần hoãn retry_after giây (None: không còn tài khoản khỏe).
+    partial giữ các item đã tải xong (theo index) để lần chạy sau dùng lại.
+    """
+
+    def __init__(self, retry_after: float | None, partial: dict | None = None):
+        self.retry_after = retry_after
+        self.partial = partial or {}
+        super().__init__("Instagram đang giới hạn truy cập")
+
+
+class CdnStatusError(Exception):
+    """CDN trả về HTTP status khác 200. retry_after: CDN đang giới hạn tốc độ, thử lại sau bấy nhiêu giây."""
+
+    def __init__(self, status: int, message: str, retry_after: float | None = None):
+        self.status = status
+        self.retry_after = retry_after
+        super().__init__(message)
+
+
+def _cdn_retry_after(status: int, headers) -> float | None:
+    """429, hoặc 503 kèm Retry-After: số giây nên chờ; None nếu không phải giới hạn tốc độ."""
+    value = headers.get("Retry-After")
+    if status != 429 and not (status == 503 and value):
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        # Retry-After dạng ngày giờ HTTP hoặc không có
+        return float(Config.CDN_RETRY_AFTER)
+
+
+def _breaker_outcome(error: BaseException) -> bool | None:
+    """
+    Kết quả của một lời gọi với circuit breaker: True nếu phía bên kia vẫn trả lời bình thường,
+    False nếu là lỗi kiểu sự cố (JSON rỗng, timeout, 5xx...), None nếu không liên quan
+    (huỷ, lỗi tài khoản đã có pool xử lý).
+    """
+    if not isinstance(error, Exception):
+        return None
+    if isinstance(error, (AccountsUnavailable, CircuitOpenError, LoginRequired)):
+        return None
+    if _is_challenge_error(error) or _is_rate_limit_error(error):
+        return None
+    if isinstance(error, (MediaNotFound, ClientNotFoundError)):
+        return True
+    if isinstance(error, CdnStatusError):
+        return error.status < 500
+    return False
+
+
+class CircuitBreaker:
+    """
+    closed: gọi bình thường, đếm lỗi liên tiếp; đủ ngưỡng thì mở.
+    open: từ chối ngay trong reset_timeout giây rồi chuyển half_open.
+    half_open: cho đúng một request thử; thành công thì đóng, lỗi thì mở lại.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self.opened = 0
+        self.rejected = 0
+
+    def _check(self) -> bool:
+        """Raise CircuitOpenError nếu phải từ chối; trả về True nếu lời gọi này là request thử."""
+        if self.state == "open":
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, remaining)
+            self.state = "half_open"
+            logger.info(f"Circuit {self.name}: half_open, cho một request thử")
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, self.reset_timeout)
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def _record(self, ok: bool | None, probe: bool) -> None:
+        if probe:
+            self._probe_in_flight = False
+        if ok is None:
+            return
+        if ok:
+            self.failures = 0
+            if probe and self.state == "half_open":
+                self.state = "closed"
+                logger.info(f"Circuit {self.name}: closed")
+            return
+        self.failures += 1
+        if probe or (self.state == "closed" and self.failures >= self.failure_threshold):
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.opened += 1
+            logger.warning(
+                f"Circuit {self.name}: open sau {self.failures} lỗi liên tiếp, "
+                f"từ chối request trong {self.reset_timeout}s"
+            )
+
+    @contextmanager
+    def guard(self):
+        """Bọc một lời gọi tới nhóm endpoint này."""
+        probe = self._check()
+        try:
+            yield
+        except BaseException as e:
+            self._record(_breaker_outcome(e), probe)
+            raise
+        self._record(True, probe)
+
+    def stats(self) -> dict:
+        return {"state": self.state, "failures": self.failures,
+                "opened": self.opened, "rejected": self.rejected}
+
+
+circuit_breakers = {
+    name: CircuitBreaker(name, Config.CIRCUIT_FAILURE_THRESHOLD, Config.CIRCUIT_RESET_TIMEOUT)
+    for name in ("media_info", "stories", "cdn")
+}
+
+
+class InstagramAccount:
+    """Một tài khoản trong pool: client, session file, fingerprint và rate budget riêng."""
+
+    def __init__(self, username: str, password: str, session_file: str):
+        self.username = username
+        self.password = password
+        self.session_file = session_file
+        # request_timeout của instagrapi không phải timeout HTTP mà là time.sleep() trước mỗi request;
+        # đặt 0 (và không dùng delay_range): nhịp request do limiter điều phối, chỉ chờ khi bucket hết token.
+        self.client = InstagramBotClient(request_timeout=0)
+        self.limiter = RateLimiter({
+            "login": Config.RATE_LIMIT_LOGIN,
+            "media_info": Config.RATE_LIMIT_MEDIA_INFO,
+            "stories": Config.RATE_LIMIT_STORIES,
+        })
+        self.healthy = True
+        self.in_flight = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self.cooldown_until = 0.0
+        # instagrapi Client không thread-safe (last_json, session, cookie, _medias_cache dùng chung):
+        # mỗi client chỉ chạy một lời gọi tại một thời điểm. Khoá chờ trong event loop, không giữ thread của pool.
+        self.lock = asyncio.Lock()
+        # Nhiều lời gọi cùng gặp LoginRequired chỉ đăng nhập lại một lần; thế hệ session tăng sau mỗi lần
+        # đăng nhập lại thành công để các lời gọi còn lại dùng luôn session mới
+        self.relogin_lock = asyncio.Lock()
+        self.session_generation = 0
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and time.monotonic() >= self.cooldown_until
+
+    def cool_down(self, seconds: float) -> None:
+        self.rate_limited += 1
+        metrics.rate_limits.inc(account=self.username)
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+        logger.warning(f"⚠️ Tài khoản @{self.username} bị rate limit, tạm nghỉ {int(seconds)} giây")
+
+    async def call(self, fn, *args, **kwargs):
+        """
+        Chạy fn trên thread instagrapi khi tài khoản rảnh. Khoá chỉ được trả khi thread chạy xong
+        (người gọi bị huỷ giữa chừng thì client vẫn đang bận tới lúc đó).
+        """
+        await self.lock.acquire()
+        loop = asyncio.get_running_loop()
+        gate = threading.Lock()
+        state = {"started": False, "abandoned": False, "released": False}
+
+        def _release():
+            if not state["released"]:
+                state["released"] = True
+                self.lock.release()
+
+        def _locked():
+            with gate:
+                if state["abandoned"]:
+                    return None
+                state["started"] = True
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                try:
+                    loop.call_soon_threadsafe(_release)
+                except RuntimeError:
+                    pass  # Loop đã đóng lúc tắt bot
+
+        try:
+            return await ig_call(_locked)
+        except asyncio.CancelledError:
+            with gate:
+                if not state["started"]:
+                    # Job chưa chạy thì không bao giờ chạy nữa: trả khoá ngay
+                    state["abandoned"] = True
+                    _release()
+            raise
+
+
+class InstagramClientPool:
+    """
+    Pool nhiều tài khoản Instagram. Mỗi request đi tới tài khoản khỏe đang ít việc nhất;
+    tài khoản bị rate limit được tạm nghỉ, tài khoản dính challenge bị loại khỏi pool.
+    """
+
+    def __init__(self, accounts: list):
+        self.accounts = accounts
+
+    def retry_after(self) -> float | None:
+        """Số giây tới khi có tài khoản dùng được (0 nếu có ngay); None nếu không còn tài khoản khỏe."""
+        cooling = [a.cooldown_until for a in self.accounts if a.healthy]
+        return max(0.0, min(cooling) - time.monotonic()) if cooling else None
+
+    def pick(self, exclude: InstagramAccount | None = None) -> InstagramAccount:
+        candidates = [a for a in self.accounts if a.available and a is not exclude]
+        if not candidates:
+            raise AccountsUnavailable(self.retry_after())
+        return min(candidates, key=lambda a: (a.in_flight, a.requests))
+
+    def remove(self, account: InstagramAccount, reason: str) -> None:
+        account.healthy = False
+        logger.error(f"❌ Loại tài khoản @{account.username} khỏi pool: {reason}")
+
+    def _penalize(self, account: InstagramAccount, error: Exception) -> bool:
+        """Challenge thì loại tài khoản, rate limit thì cho tạm nghỉ; False nếu không phải hai lỗi đó."""
+        if _is_challenge_error(error):
+            self.remove(account, "Instagram yêu cầu xác minh (challenge)")
+        elif _is_rate_limit_error(error):
+            account.cool_down(Config.ACCOUNT_COOLDOWN_SECONDS)
+        else:
+            return False
+        return True
+
+    async def _relogin(self, account: InstagramAccount) -> None:
+        """Đăng nhập lại đúng tài khoản này (không hỏi mã, không ngủ); hỏng hẳn thì loại khỏi pool."""
+        wait = account.limiter.buckets["login"].try_reserve()
+        if wait > 0:
+            # Hết token login: tạm nghỉ tới khi có token thay vì ngủ trong thread
+            account.cool_down(wait)
+            return
+        try:
+            relogged = await account.call(login_account, account)
+        except Exception as login_error:
+            relogged = False
+            if not self._penalize(account, login_error):
+                self.remove(account, f"đăng nhập lại thất bại: {login_error}")
+        else:
+            if relogged:
+                account.session_generation += 1
+            else:
+                self.remove(account, "đăng nhập lại thất bại")
+        metrics.relogins.inc(result="ok" if relogged else "failed")
+
+    def has_spare(self, exclude: InstagramAccount) -> bool:
+        """Còn tài khoản dùng được ngoài exclude (để hedge không tranh khoá client với request chính)."""
+        return any(a.available and a is not exclude for a in self.accounts)
+
+    @asynccontextmanager
+    async def lease(self, exclude: InstagramAccount | None = None):
+        """Mượn tài khoản ít tải nhất cho một chuỗi lời gọi Instagram."""
+        account = self.pick(exclude)
+        account.in_flight += 1
+        account.requests += 1
+        generation = account.session_generation
+        try:
+            yield account
+        except LoginRequired:
+            async with account.relogin_lock:
+                if account.session_generation == generation and account.available:
+                    await self._relogin(account)
+            raise
+        except Exception as e:
+            self._penalize(account, e)
+            raise
+        finally:
+            account.in_flight -= 1
+
+    def stats(self) -> list:
+        now = time.monotonic()
+        return [
+            {"username": a.username, "healthy": a.healthy, "in_flight": a.in_flight,
+             "requests": a.requests, "rate_limited": a.rate_limited,
+             "cooldown": max(0.0, a.cooldown_until - now)}
+            for a in self.accounts
+        ]
+
+
+def _configured_accounts() -> list:
+    """Tài khoản chính (.env) dùng session cũ instagram_session.json, tài khoản phụ có session riêng."""
+    accounts = [InstagramAccount(Config.INSTAGRAM_USERNAME, Config.INSTAGRAM_PASSWORD, "instagram_session.json")]
+    for entry in filter(None, (e.strip() for e in Config.INSTAGRAM_EXTRA_ACCOUNTS.split(","))):
+        username, _, password = entry.partition(":")
+        accounts.append(InstagramAccount(username, password, f"instagram_session_{username}.json"))
+    return accounts
+
+
+client_pool = InstagramClientPool(_configured_accounts())
+# Client của tài khoản chính, chỉ dùng cho các hàm tính cục bộ (media_pk_from_code...), không gửi request
+cl = client_pool.accounts[0].client
+
+
+class FileIdCache:
+    """
+    Lưu file_id Telegram trả về sau mỗi lần upload, theo media pk + vị trí trong carousel.
+    Cache hit thì gửi lại bằng file_id, không cần gọi Instagram hay tải từ CDN.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS media_file_ids (
+                media_pk TEXT NOT NULL,
+                item_index INTEGER NOT NULL,
+                file_id TEXT NOT NULL,
+                media_type TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                kind TEXT NOT NULL DEFAULT 'document',
+                PRIMARY KEY (media_pk, item_index)
+            );
+            CREATE TABLE IF NOT EXISTS posts (
+                media_pk TEXT PRIMARY KEY,
+                item_count INTEGER NOT NULL,
+                username TEXT NOT NULL,
+                post_info TEXT,
+                created_at REAL NOT NULL
+            );
+            """
+        )
+        # DB tạo trước khi có chế độ media_group: file_id khi đó đều là document
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(media_file_ids)")}
+        if "kind" not in columns:
+            self._conn.execute(
+                "ALTER TABLE media_file_ids ADD COLUMN kind TEXT NOT NULL DEFAULT 'document'"
+            )
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get_item(self, media_pk: str, index: int = 0) -> dict | None:
+        row = self._conn.execute(
+            "SELECT file_id, media_type, kind FROM media_file_ids WHERE media_pk = ? AND item_index = ?",
+            (str(media_pk), index),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {"file_id": row[0], "type": row[1], "kind": row[2], "media_pk": str(media_pk), "index": index}
+
+    def get_post(self, media_pk: str) -> list | None:
+        """Trả về toàn bộ item của bài viết, hoặc None nếu cache chưa đủ mọi item."""
+        post = self._conn.execute(
+            "SELECT item_count, username, post_info FROM posts WHERE media_pk = ?",
+            (str(media_pk),),
+        ).fetchone()
+        rows = []
+        if post is not None:
+            rows = self._conn.execute(
+                "SELECT item_index, file_id, media_type, kind FROM media_file_ids "
+                "WHERE media_pk = ? ORDER BY item_index",
+                (str(media_pk),),
+            ).fetchall()
+        if post is None or len(rows) < post[0]:
+            self.misses += 1
+            return None
+        self.hits += 1
+        item_count, username, post_info = post
+        items = [
+            {"file_id": file_id, "type": media_type, "kind": kind, "username": username,
+             "media_pk": str(media_pk), "index": index}
+            for index, file_id, media_type, kind in rows
+        ]
+        items[0]["post_info"] = post_info
+        items[0]["item_count"] = item_count
+        return items
+
+    def put_item(self, media_pk: str, index: int, file_id: str, media_type: str,
+                 kind: str = "document") -> None:
+        """kind: loại tin nhắn Telegram giữ file_id (document, photo, video)."""
+        self._conn.execute(
+            "INSERT OR REPLACE INTO media_file_ids "
+            "(media_pk, item_index, file_id, media_type, kind, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (str(media_pk), index, file_id, media_type, kind, time.time()),
+        )
+        self._conn.commit()
+
+    def put_post(self, media_pk: str, item_count: int, username: str, post_info: str | None) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?)",
+            (str(media_pk), item_count, username, post_info, time.time()),
+        )
+        self._conn.commit()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+file_id_cache = FileIdCache(Config.FILE_ID_CACHE_PATH)
+
+
+class MediaLeases:
+    """
+    Đếm tham chiếu các file đã tải. Nhiều chat có thể cùng gửi một file (single-flight),
+    nên file chỉ bị xoá khi người gửi cuối cùng đã xong.
+    """
+
+    def __init__(self):
+        self._refs = {}
+
+    def acquire(self, paths, count: int = 1) -> None:
+        for path in paths:
+            self._refs[path] = self._refs.get(path, 0) + count
+
+    def release(self, paths) -> None:
+        for path in paths:
+            left = self._refs.get(path, 0) - 1
+            if left > 0:
+                self._refs[path] = left
+                continue
+            self._refs.pop(path, None)
+            if media_disk_cache.owns(path):
+                # File trong cache đĩa được giữ lại, chỉ bị xoá khi evict LRU
+                continue
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+                    logger.info(f"Đã xóa file: {path}")
+                post_dir = os.path.dirname(path)
+                if os.path.isdir(post_dir) and not os.listdir(post_dir):
+                    os.rmdir(post_dir)
+                    logger.info(f"Đã xóa thư mục rỗng: {post_dir}")
+            except Exception as e:
+                logger.error(f"Lỗi khi xóa file {path}: {e}")
+
+    def in_use(self, path: str) -> bool:
+        return path in self._refs
+
+
+def _media_paths(media_items) -> list:
+    return [item["path"] for item in media_items or [] if item.get("path")]
+
+
+# Lease mà cache đĩa lấy trên blob trong lượt single-flight đang chạy; _finish trả lại
+# sau khi các waiter đã có lease riêng, nên blob không bị evict giữa put() và lúc gửi
+_flight_pins = contextvars.ContextVar("instagrap_flight_pins", default=None)
+
+
+class _Flight:
+    __slots__ = ("task", "waiters", "pins", "finished")
+
+    def __init__(self, task: asyncio.Task, pins: list):
+        self.task = task
+        self.waiters = 0
+        self.pins = pins
+        self.finished = False
+
+
+class SingleFlight:
+    """
+    Gộp các request đồng thời cùng key (media pk / chủ story) thành một lần fetch + download.
+    Mỗi waiter nhận bản sao riêng của các item (lúc gửi item bị sửa: path, url_rejected...),
+    giữ một lease trên các file và phải gọi MediaLeases.release() khi gửi xong.
+    """
+
+    def __init__(self, leases: MediaLeases):
+        self._leases = leases
+        self._flights = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn):
+        flight = self._flights.get(key)
+        if flight is None:
+            pins = []
+            token = _flight_pins.set(pins)
+            try:
+                # Task copy context lúc tạo: mọi lease của cache trong lượt tải ghi vào pins
+                flight = _Flight(asyncio.ensure_future(fn()), pins)
+            finally:
+                _flight_pins.reset(token)
+            self._flights[key] = flight
+            flight.task.add_done_callback(functools.partial(self._finish, key, flight))
+            self.started += 1
+        else:
+            self.coalesced += 1
+            logger.info(f"Gộp request vào lượt tải đang chạy: {key}")
+        flight.waiters += 1
+        try:
+            # shield: một chat huỷ không được huỷ lượt tải của các chat khác
+            items = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if not flight.finished:
+                # _finish chưa chạy: không lấy lease cho waiter này nữa
+                flight.waiters -= 1
+            elif not flight.task.cancelled() and flight.task.exception() is None:
+                # _finish đã lấy lease cho waiter này: trả lại
+                self._leases.release(_media_paths(flight.task.result()))
+            raise
+        return [dict(item) for item in items] if items else items
+
+    def _finish(self, key: str, flight: _Flight, task: asyncio.Task) -> None:
+        flight.finished = True
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not task.cancelled() and task.exception() is None:
+            paths = _media_paths(task.result())
+            if flight.waiters:
+                self._leases.acquire(paths, flight.waiters)
+            else:
+                # Mọi waiter đã huỷ: không ai gửi, dọn file (trừ file lượt khác đang dùng)
+                self._leases.release([path for path in paths if not self._leases.in_use(path)])
+        self._leases.release(flight.pins)
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._flights), "started": self.started, "coalesced": self.coalesced}
+
+
+media_leases = MediaLeases()
+media_flights = SingleFlight(media_leases)
+
+
+def _remove_empty_dir(directory: str) -> None:
+    """Dọn thư mục tải của bài viết / story khi mọi file đã vào cache đĩa."""
+    try:
+        if os.path.isdir(directory) and not os.listdir(directory):
+            os.rmdir(directory)
+    except OSError:
+        pass
+
+
+class MediaDiskCache:
+    """
+    Cache media trên đĩa theo nội dung: file lưu tại <dir>/<sha[:2]>/<sha[2:4]>/<sha>.<ext>,
+    bytes giống nhau chỉ lưu một lần. Index SQLite (WAL) map "<media pk>:<resource pk>" -> sha,
+    hết hạn cùng URL CDN; blob bị evict theo LRU khi vượt max_bytes, bỏ qua blob còn lease (MediaLeases).
+    get()/put() trả về blob đã có một lease cho người gọi (xem fetch_resource).
+    """
+
+    def __init__(self, directory: str, max_bytes: int, leases: MediaLeases):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self._leases = leases
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.deduped = 0
+        self.evicted = 0
+        self._conn = None
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(self.directory, "index.sqlite3"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS resources (
+                key TEXT PRIMARY KEY,
+                sha TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS blobs (
+                sha TEXT PRIMARY KEY,
+                ext TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0,
+                last_used REAL NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs (last_used)")
+        self._conn.commit()
+        self.total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def blob_path(self, sha: str, ext: str) -> str:
+        return os.path.join(self.directory, sha[:2], sha[2:4], f"{sha}.{ext}")
+
+    def owns(self, path: str) -> bool:
+        return self.enabled and os.path.abspath(path).startswith(self.directory + os.sep)
+
+    def get(self, key: str) -> str | None:
+        """Đường dẫn blob của resource nếu còn hạn và file còn trên đĩa."""
+        if not self.enabled:
+            return None
+        row = self._conn.execute(
+            "SELECT r.sha, r.expires_at, b.ext FROM resources r JOIN blobs b ON b.sha = r.sha WHERE r.key = ?",
+            (key,),
+        ).fetchone()
+        if row is not None and row[1] <= time.time():
+            self.expired += 1
+            self._conn.execute("DELETE FROM resources WHERE key = ?", (key,))
+            self._conn.commit()
+            row = None
+        if row is not None and not os.path.exists(self.blob_path(row[0], row[2])):
+            # File bị xoá ngoài ý muốn: bỏ blob khỏi index
+            self._forget(row[0])
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._conn.execute(
+            "UPDATE blobs SET hits = hits + 1, last_used = ? WHERE sha = ?", (time.time(), row[0])
+        )
+        self._conn.commit()
+        blob = self.blob_path(row[0], row[2])
+        self._leases.acquire([blob])
+        return blob
+
+    def put(self, key: str, path: str, sha: str, expires_at: float) -> str:
+        """Chuyển file vừa tải vào cache, trả về đường dẫn blob (dùng thay cho path)."""
+        now = time.time()
+        ext = path.rsplit(".", 1)[1].lower() if "." in os.path.basename(path) else "bin"
+        row = self._conn.execute("SELECT ext FROM blobs WHERE sha = ?", (sha,)).fetchone()
+        if row is not None and os.path.exists(self.blob_path(sha, row[0])):
+            # Cùng nội dung đã có trong cache: bỏ bản vừa tải
+            self.deduped += 1
+            blob = self.blob_path(sha, row[0])
+            os.remove(path)
+            self._conn.execute("UPDATE blobs SET last_used = ? WHERE sha = ?", (now, sha))
+        else:
+            blob = self.blob_path(sha, ext)
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.replace(path, blob)
+            size = os.path.getsize(blob)
+            if row is not None:
+                self.total_bytes -= self._conn.execute("SELECT size FROM blobs WHERE sha = ?", (sha,)).fetchone()[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, 0, ?, ?)", (sha, ext, size, now, now)
+            )
+            self.total_bytes += size
+        if expires_at > now:
+            self._conn.execute("INSERT OR REPLACE INTO resources VALUES (?, ?, ?)", (key, sha, expires_at))
+        self._conn.commit()
+        _remove_empty_dir(os.path.dirname(path))
+        # Lease trước khi evict: blob vừa put không bao giờ bị evict trước khi tới tay người gọi
+        self._leases.acquire([blob])
+        self._evict()
+        return blob
+
+    def _forget(self, sha: str) -> None:
+        row = self._conn.execute("SELECT size FROM blobs WHERE sha = ?", (sha,)).fetchone()
+        if row is not None:
+            self.total_bytes -= row[0]
+        self._conn.execute("DELETE FROM resources WHERE sha = ?", (sha,))
+        self._conn.execute("DELETE FROM blobs WHERE sha = ?", (sha,))
+        self._conn.commit()
+
+    def _evict(self) -> None:
+        if self.total_bytes <= self.max_bytes:
+            return
+        # LRU thuần; chỉ vượt max_bytes khi mọi blob còn lại đều đang có lease
+        rows = self._conn.execute("SELECT sha, ext, size FROM blobs ORDER BY last_used").fetchall()
+        for sha, ext, size in rows:
+            if self.total_bytes <= self.max_bytes:
+                break
+            blob = self.blob_path(sha, ext)
+            if self._leases.in_use(blob):
+                continue
+            try:
+                os.remove(blob)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Lỗi khi xóa file cache {blob}: {e}")
+                continue
+            self._forget(sha)
+            self.evicted += 1
+            logger.info(f"Evict file cache {os.path.basename(blob)} ({size} bytes)")
+            for shard in (os.path.dirname(blob), os.path.dirname(os.path.dirname(blob))):
+                try:
+                    os.rmdir(shard)
+                except OSError:
+                    break
+
+    def stats(self) -> dict:
+        if not self.enabled:
+            return {"enabled": False}
+        files, top_hits = self._conn.execute("SELECT COUNT(*), COALESCE(MAX(hits), 0) FROM blobs").fetchone()
+        return {
+            "hits": self.hits, "misses": self.misses, "expired": self.expired, "deduped": self.deduped,
+            "evicted": self.evicted, "files": files, "bytes": self.total_bytes, "max_bytes": self.max_bytes,
+            "top_blob_hits": top_hits,
+        }
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+
+
+media_disk_cache = MediaDiskCache(Config.MEDIA_CACHE_DIR, Config.MEDIA_CACHE_MAX_BYTES, media_leases)
+
+
+# HTTP client dùng chung cho CDN (scontent-*.cdninstagram.com): giữ kết nối TCP+TLS và cache DNS
+http_session: aiohttp.ClientSession | None = None
+
+
+def create_http_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=Config.HTTP_POOL_LIMIT,
+        limit_per_host=Config.HTTP_POOL_LIMIT_PER_HOST,
+        ttl_dns_cache=Config.HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=Config.HTTP_KEEPALIVE_TIMEOUT,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=60),
+    )
+
+
+# Giới hạn toàn cục số lượt tải CDN chạy cùng lúc (mọi bài viết, story cộng lại)
+cdn_download_semaphore = asyncio.Semaphore(Config.CDN_MAX_CONCURRENT_DOWNLOADS)
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Session được tạo trong main(); tạo muộn nếu hàm tải được gọi ngoài bot (script, benchmark)."""
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = create_http_session()
+    return http_session
+
+
+async def close_http_session() -> None:
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+
+def _url_extension(url: str, default: str) -> str:
+    """Đuôi file theo path của URL CDN (jpg, webp, mp4...)."""
+    name = urlparse(str(url)).path.rsplit("/", 1)[-1]
+    return name.rsplit(".", 1)[1].lower() if "." in name else default
+
+
+@dataclass
+class DownloadStats:
+    """Kết quả một lượt tải streaming."""
+    path: str
+    size: int
+    ttfb: float  # Giây từ lúc gửi request tới khi nhận byte đầu tiên
+    elapsed: float
+    sha256: str = ""
+    deferred: bool = False  # Chưa tải: lúc gửi mới lấy từ URL (xem fetch_resource)
+
+    @property
+    def bytes_per_sec(self) -> float:
+        return self.size / self.elapsed if self.elapsed > 0 else 0.0
+
+
+async def stream_download(url: str, file_path: str, timeout: int = 60) -> DownloadStats:
+    """
+    Tải một URL CDN về file theo từng chunk cố định qua session dùng chung,
+    bộ nhớ chỉ tốn một chunk bất kể dung lượng file. Ghi vào file .part rồi mới đổi tên,
+    nên file ở đường dẫn đích luôn là file đầy đủ.
+    """
+    with tracer.span("cdn_download", file=os.path.basename(file_path)) as span:
+        part_path = file_path + ".part"
+        size = 0
+        ttfb = None
+        digest = hashlib.sha256()
+        await rate_limiter.acquire("cdn")
+        async with cdn_download_semaphore:
+            started = time.monotonic()
+            try:
+                with circuit_breakers["cdn"].guard():
+                    async with get_http_session().get(
+                        str(url), timeout=aiohttp.ClientTimeout(total=timeout)
+                    ) as response:
+                        if response.status != 200:
+                            raise CdnStatusError(
+                                response.status,
+                                f"Không thể tải {os.path.basename(file_path)} (HTTP {response.status})",
+                                _cdn_retry_after(response.status, response.headers),
+                            )
+                        # Content-Length chỉ so được với số byte nhận khi body không bị nén
+                        expected = None if response.headers.get("Content-Encoding") else response.content_length
+                        # Thư mục có thể vừa bị cache đĩa dọn khi rỗng
+                        os.makedirs(os.path.dirname(part_path) or ".", exist_ok=True)
+                        with open(part_path, 'wb') as f:
+                            async for chunk in response.content.iter_chunked(Config.DOWNLOAD_CHUNK_SIZE):
+                                if ttfb is None:
+                                    ttfb = time.monotonic() - started
+                                f.write(chunk)
+                                digest.update(chunk)
+                                size += len(chunk)
+                        if expected is not None and size != expected:
+                            raise Exception(
+                                f"Tải thiếu {os.path.basename(file_path)}: {size}/{expected} bytes"
+                            )
+                os.replace(part_path, file_path)
+            except BaseException:
+                try:
+                    os.remove(part_path)
+                except OSError:
+                    pass
+                raise
+        span.attrs.update(bytes=size, ttfb_ms=round((ttfb or 0.0) * 1000))
+
+    stats = DownloadStats(file_path, size, ttfb or 0.0, time.monotonic() - started, digest.hexdigest())
+    metrics.stage_seconds.observe(stats.elapsed, stage="cdn_download")
+    metrics.downloaded_bytes.inc(size)
+    logger.info(
+        f"Đã tải {os.path.basename(file_path)}: {size} bytes, "
+        f"TTFB {stats.ttfb:.2f}s, {stats.bytes_per_sec / 1024:.0f} KB/s"
+    )
+    return stats
+
+
+def resource_key(media_pk, resource_pk=None) -> str:
+    """
+    Key cache đĩa "<media pk>:<resource pk>". Item con của album dùng pk riêng;
+    ảnh/video đơn và story là resource duy nhất của chính nó nên resource pk là 0.
+    """
+    return f"{media_pk}:{resource_pk if resource_pk is not None else 0}"
+
+
+async def fetch_resource(key: str, url: str, file_path: str, defer: bool = False, timeout: int = 60) -> DownloadStats:
+    """
+    stream_download qua cache đĩa: resource (key theo resource_key) đã tải trong thời hạn
+    URL CDN thì trả luôn file trong cache, không tải lại. Đường dẫn trả về có thể là blob của cache.
+    defer: cache miss thì không tải, trả stats.deferred; item mang source_url để lúc gửi
+    Telegram tự lấy URL hoặc stream (pipe), chỉ tải về đĩa khi cần (ensure_local).
+    Blob của cache có một lease: trong single-flight thì _finish trả lại, ngoài đó người gọi tự release.
+    """
+    cached = _pinned(media_disk_cache.get(key))
+    if cached is not None:
+        logger.info(f"Cache hit file {key}: {os.path.basename(cached)}")
+        _remove_empty_dir(os.path.dirname(file_path))
+        return DownloadStats(cached, os.path.getsize(cached), 0.0, 0.0)
+    if defer:
+        return DownloadStats(file_path, 0, 0.0, 0.0, deferred=True)
+    stats = await stream_download(url, file_path, timeout=timeout)
+    if not media_disk_cache.enabled:
+        return stats
+    # URL story là HttpUrl (pydantic), urlparse cần chuỗi
+    expires_at = _cdn_url_expiry(str(url)) or time.time() + Config.MEDIA_META_DEFAULT_TTL
+    stats.path = _pinned(media_disk_cache.put(key, stats.path, stats.sha256, expires_at))
+    return stats
+
+
+def _pinned(blob: str | None) -> str | None:
+    """Giao lease của blob cho lượt single-flight đang chạy (nếu có)."""
+    pins = _flight_pins.get()
+    if blob is not None and pins is not None:
+        pins.append(blob)
+    return blob
+
+
+def _pin_existing(path: str) -> str:
+    """File có sẵn do lượt tải khác tạo ra: lấy lease ngay để không bị xoá trước khi lượt này gửi xong."""
+    pins = _flight_pins.get()
+    if pins is not None:
+        media_leases.acquire([path])
+        pins.append(path)
+    return path
+
+
+async def _nested_flight(key: str, fn) -> list:
+    """
+    media_flights.do bên trong một lượt single-flight khác: lease mà lượt con cấp cho lượt này
+    được giao cho lượt ngoài, trả lại trong _finish của lượt ngoài.
+    """
+    items = await media_flights.do(key, fn)
+    pins = _flight_pins.get()
+    if pins is not None:
+        pins.extend(_media_paths(items))
+    return items
+
+
+def _defer_download(media_type: str) -> bool:
+    """Resource có được hoãn tải tới lúc gửi không (gửi bằng URL, hoặc video ở chế độ pipe)."""
+    return Config.TELEGRAM_SEND_BY_URL or (Config.TELEGRAM_PIPE_MODE and media_type == "video")
+
+
+def _deferred_fields(stats: DownloadStats, key: str, url: str) -> dict:
+    # URL story của instagrapi là HttpUrl (pydantic), Bot API cần chuỗi
+    return {"source_url": str(url), "cache_key": key} if stats.deferred else {}
+
+
+def _is_remote(media_item: dict) -> bool:
+    """Item chưa có file trên đĩa, chỉ có URL CDN."""
+    return bool(media_item.get("source_url")) and not os.path.exists(media_item["path"])
+
+
+async def ensure_local(media_item: dict) -> None:
+    """
+    Tải item hoãn về đĩa (hoặc lấy từ cache) khi Telegram không tự lấy được / pipe lỗi.
+    Nhiều chat cùng cần một resource thì chỉ một lượt tải (không ghi chồng file .part);
+    mỗi chat giữ lease trên file tải được, trả lại qua _local_lease_paths khi job xong.
+    """
+    if not _is_remote(media_item):
+        return
+    key, url, path = media_item["cache_key"], media_item["source_url"], media_item["path"]
+
+    async def _fetch():
+        return [{"path": (await fetch_resource(key, url, path)).path}]
+
+    (local,) = await media_flights.do(f"local:{key}", _fetch)
+    media_item["path"] = local["path"]
+    media_item["local_lease"] = True
+
+
+def _local_lease_paths(media_items) -> list:
+    """File mà ensure_local đã lấy lease cho waiter này."""
+    return [item["path"] for item in media_items or [] if item.get("local_lease")]
 
 
 def _is_json_parse_error(error: Exception) -> bool:
@@ -89,57 +1649,307 @@ def _is_json_parse_error(error: Exception) -> bool:
     return "expecting value: line 1 column 1" in message or "jsondecodeerror" in message
 
 
+class StrategyStats:
+    """
+    Tỉ lệ thành công và latency cuộn (window lần gần nhất) của từng nguồn media_info.
+    Nguồn đang chạy tốt được thử trước; nguồn lỗi liên tiếp bị bỏ qua một thời gian.
+    """
+
+    def __init__(self, window: int, failure_threshold: int, cooloff: float):
+        self.window = window
+        self.failure_threshold = failure_threshold
+        self.cooloff = cooloff
+        self._results = {}  # name -> deque[(ok, latency)]
+        self._consecutive_failures = {}
+        self._cooloff_until = {}
+        self._probing = {}
+        self._last_tried = {}
+        self._last_order = None
+
+    def record(self, name: str, ok: bool, latency: float) -> None:
+        results = self._results.setdefault(name, deque(maxlen=self.window))
+        self._last_tried[name] = time.monotonic()
+        if ok and self._probing.pop(name, False):
+            # Nguồn vừa hết thời gian nghỉ và thử lại thành công: xếp hạng lại từ đầu
+            logger.info(f"Nguồn {name} hoạt động trở lại")
+            results.clear()
+        results.append((ok, latency))
+        if ok:
+            self._consecutive_failures[name] = 0
+            return
+        self._probing.pop(name, None)
+        failures = self._consecutive_failures.get(name, 0) + 1
+        self._consecutive_failures[name] = failures
+        if failures >= self.failure_threshold:
+            self._cooloff_until[name] = time.monotonic() + self.cooloff
+            logger.warning(f"Tạm bỏ qua nguồn {name} trong {self.cooloff:.0f}s sau {failures} lỗi liên tiếp")
+
+    def success_rate(self, name: str) -> float:
+        results = self._results.get(name)
+        if not results:
+            return 1.0  # Chưa có dữ liệu: cho thử như nguồn tốt
+        return sum(ok for ok, _ in results) / len(results)
+
+    def avg_latency(self, name: str) -> float:
+        latencies = [lat for ok, lat in self._results.get(name, ()) if ok]
+        return sum(latencies) / len(latencies) if latencies else 0.0
+
+    def latency_percentile(self, name: str, q: float) -> float | None:
+        """Percentile q (0..1) latency các lần thành công; None khi chưa đủ mẫu."""
+        latencies = sorted(lat for ok, lat in self._results.get(name, ()) if ok)
+        if len(latencies) < 10:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def cooling(self, name: str) -> bool:
+        return self._cooloff_until.get(name, 0) > time.monotonic()
+
+    def order(self, names: list) -> list:
+        """
+        Thứ tự thử: nguồn vừa hết thời gian nghỉ (hoặc đã lỗi mà lâu chưa được thử lại) được thử
+        một lần trước tiên, bỏ nguồn đang nghỉ (trừ khi tất cả đều nghỉ), còn lại theo tỉ lệ
+        thành công rồi latency.
+        """
+        now = time.monotonic()
+        probes = []
+        for name in names:
+            until = self._cooloff_until.get(name)
+            stale = (
+                until is None
+                and self.success_rate(name) < 1.0
+                and now - self._last_tried.get(name, now) >= self.cooloff
+            )
+            if (until is not None and until <= now) or stale:
+                self._cooloff_until.pop(name, None)
+                self._probing[name] = True
+                probes.append(name)
+        active = [n for n in names if not self.cooling(n) and n not in probes] or [
+            n for n in names if n not in probes
+        ]
+        ordered = probes + sorted(
+            active,
+            key=lambda n: (-self.success_rate(n), self.avg_latency(n), names.index(n)),
+        )
+        if ordered != self._last_order:
+            logger.debug(f"Thứ tự nguồn media_info: {' → '.join(ordered)}")
+            self._last_order = ordered
+        return ordered
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            name: {
+                "samples": len(results),
+                "success_rate": round(self.success_rate(name), 3),
+                "avg_latency": round(self.avg_latency(name), 3),
+                "consecutive_failures": self._consecutive_failures.get(name, 0),
+                "cooloff": round(max(0.0, self._cooloff_until.get(name, 0) - now), 1),
+            }
+            for name, results in self._results.items()
+        } | {"order": self._last_order}
+
+
+media_strategy_stats = StrategyStats(
+    Config.MEDIA_STRATEGY_WINDOW,
+    Config.MEDIA_STRATEGY_FAILURE_THRESHOLD,
+    Config.MEDIA_STRATEGY_COOLOFF,
+)
+
+
+class RatioBudget:
+    """
+    Giới hạn request phát sinh thêm (retry, hedge) theo tỉ lệ request gốc: mỗi request gốc
+    cộng ratio token (tối đa max_tokens), mỗi request phát sinh tốn 1 token.
+    """
+
+    def __init__(self, ratio: float, max_tokens: float = 5, initial_tokens: float = 0.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = initial_tokens
+        self.requests = 0
+        self.spent = 0
+        self.denied = 0
+
+    def on_request(self) -> None:
+        self.requests += 1
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.tokens < 1:
+            self.denied += 1
+            return False
+        self.tokens -= 1
+        self.spent += 1
+        return True
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "spent": self.spent, "denied": self.denied,
+                "tokens": round(self.tokens, 2)}
+
+
+class HedgeBudget(RatioBudget):
+    """RatioBudget cho hedge media_info, đếm thêm số lần nguồn hedge thắng."""
+
+    def __init__(self, ratio: float, max_tokens: float = 5):
+        super().__init__(ratio, max_tokens)
+        self.hedge_wins = 0
+
+    def stats(self) -> dict:
+        return {"enabled": Config.MEDIA_HEDGE_ENABLED, "hedge_wins": self.hedge_wins} | super().stats()
+
+
+media_hedge_budget = HedgeBudget(Config.MEDIA_HEDGE_MAX_RATIO)
+# Retry (vòng backoff, đăng nhập lại, chờ hết rate limit) tính chung cả bot; đầy sẵn để lúc mới chạy vẫn retry được
+retry_budget = RatioBudget(Config.RETRY_BUDGET_RATIO, max_tokens=10, initial_tokens=10)
+
+def _is_fatal_media_error(error: Exception) -> bool:
+    """Lỗi mà thử nguồn khác cũng vô ích (hoặc làm tài khoản tệ hơn)."""
+    return (
+        isinstance(error, (MediaNotFound, ClientNotFoundError, LoginRequired))
+        or _is_challenge_error(error)
+        or _is_rate_limit_error(error)
+    )
+
+
 async def fetch_media_info_resilient(media_pk: str, shortcode: str | None = None):
     """
     Instagram thường trả body rỗng; instagrapi bọc lỗi trong ClientJSONDecodeError.
-    Thử lần lượt nhiều nguồn (v1, web a1, GQL có session, media_info kết hợp) + backoff.
+    Thử nhiều nguồn (v1, web a1, GQL có session, media_info kết hợp) + backoff, theo thứ tự
+    do media_strategy_stats xếp, trên tài khoản ít tải nhất của pool. Vòng retry tính vào retry_budget.
     """
-    pk = cl.media_pk(media_pk)
-    delays = [1, 2, 4, 8]
-    last_err = None
-
-    def _strategies():
-        if cl.user_id:
-            yield "media_info_v1", lambda: cl.media_info_v1(pk)
-        yield "media_info_a1", lambda: cl.media_info_a1(pk)
-        if cl.user_id:
-
-            def _gql_with_session():
-                cl.inject_sessionid_to_public()
-                return cl.media_info_gql(pk)
-
-            yield "media_info_gql", _gql_with_session
-        yield "media_info", lambda: cl.media_info(pk, use_cache=False)
-
-    for round_i, delay in enumerate(delays):
-        cl.inject_sessionid_to_public()
-        for name, fn in _strategies():
-            try:
-                media = fn()
-                if round_i:
-                    logger.info(f"Đã lấy media_info qua {name} sau {round_i} vòng retry")
-                return media
-            except (MediaNotFound, ClientNotFoundError):
-                raise
-            except Exception as e:
-                last_err = e
-                logger.debug(f"{name} thất bại: {e}")
+    # Circuit mở: báo lỗi ngay, không chiếm tài khoản hay thread
+    with circuit_breakers["media_info"].guard():
+        retry_budget.on_request()
+        async with client_pool.lease() as account:
+            pk = account.client.media_pk(media_pk)
+            delays = [1, 2, 4, 8]
+            last_err = None
+
+            def _strategies(acct: InstagramAccount) -> dict:
+                """Các nguồn trên client của acct; client đọc lúc chạy (trong khoá) vì có thể bị thay khi login lại."""
+                strategies = {}
+                if acct.client.user_id:
+                    strategies["media_info_v1"] = lambda: acct.client.media_info_v1(pk)
+                strategies["media_info_a1"] = lambda: acct.client.media_info_a1(pk)
+                if acct.client.user_id:
+
+                    def _gql_with_session():
+                        acct.client.inject_sessionid_to_public()
+                        return acct.client.media_info_gql(pk)
+
+                    strategies["media_info_gql"] = _gql_with_session
+                strategies["media_info"] = lambda: acct.client.media_info(pk, use_cache=False)
+                return strategies
+
+            async def _attempt(name: str, acct: InstagramAccount):
+                strategy = _strategies(acct).get(name)
+                if strategy is None:
+                    raise RuntimeError(f"Nguồn {name} không dùng được trên @{acct.username}")
+
+                def _run():
+                    try:
+                        return strategy()
+                    except Exception:
+                        # Không để media lỗi/nửa vời trong cache của instagrapi cho nguồn sau
+                        acct.client._medias_cache.pop(pk, None)
+                        raise
+
+                with tracer.span(name, account=acct.username):
+                    await acct.limiter.acquire("media_info")
+                    started = time.monotonic()
+                    try:
+                        media = await acct.call(_run)
+                    except Exception as e:
+                        metrics.media_info_seconds.observe(time.monotonic() - started, strategy=name, outcome="error")
+                        if not _is_fatal_media_error(e):
+                            media_strategy_stats.record(name, False, time.monotonic() - started)
+                        raise
+                    metrics.media_info_seconds.observe(time.monotonic() - started, strategy=name, outcome="ok")
+                    media_strategy_stats.record(name, True, time.monotonic() - started)
+                    return media
+
+            async def _hedge_attempt(name: str):
+                # Client instagrapi chỉ chạy một lời gọi mỗi lúc: hedge chạy trên tài khoản khác
+                async with client_pool.lease(exclude=account) as other:
+                    return await _attempt(name, other)
+
+            async def _hedged(name: str, pending: list):
+                """Chạy name; quá ngưỡng latency mà chưa xong thì chạy song song nguồn kế tiếp trên tài khoản khác."""
+                media_hedge_budget.on_request()
+                primary = asyncio.ensure_future(_attempt(name, account))
+                if not pending or not client_pool.has_spare(exclude=account):
+                    return name, await primary
+                hedge_name = pending[0]
+                percentile = media_strategy_stats.latency_percentile(name, Config.MEDIA_HEDGE_PERCENTILE)
+                threshold = (
+                    max(Config.MEDIA_HEDGE_MIN_DELAY, percentile)
+                    if percentile is not None
+                    else Config.MEDIA_HEDGE_DEFAULT_DELAY
+                )
+                done, _ = await asyncio.wait({primary}, timeout=threshold)
+                if done or not client_pool.has_spare(exclude=account) or not media_hedge_budget.try_spend():
+                    return name, await primary
+
+                pending.remove(hedge_name)
+                logger.info(f"{name} chưa trả lời sau {threshold:.1f}s, chạy song song {hedge_name}")
+                tasks = {primary: name, asyncio.ensure_future(_hedge_attempt(hedge_name)): hedge_name}
+                last_err = None
                 try:
-                    cl._medias_cache.pop(pk, None)
-                except Exception:
-                    pass
-                continue
-        if round_i < len(delays) - 1 and last_err is not None and _is_json_parse_error(last_err):
-            logger.warning(
-                f"Mọi nguồn media_info đều lỗi JSON (vòng {round_i + 1}/{len(delays)}), chờ {delay}s..."
-            )
-            await asyncio.sleep(delay)
-            continue
-        break
+                    while tasks:
+                        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            task_name = tasks.pop(task)
+                            if task.exception() is None:
+                                if task_name == hedge_name:
+                                    media_hedge_budget.hedge_wins += 1
+                                return task_name, task.result()
+                            last_err = task.exception()
+                            # Lỗi tài khoản của hedge (challenge, rate limit...) đã được lease xử lý, không làm hỏng request chính
+                            if _is_fatal_media_error(last_err) and (
+                                task is primary or isinstance(last_err, (MediaNotFound, ClientNotFoundError))
+                            ):
+                                raise last_err
+                    raise last_err
+                finally:
+                    # Thread instagrapi đang chạy không huỷ được; kết quả của nguồn thua bị bỏ qua
+                    for task in tasks:
+                        task.cancel()
 
-    if last_err is not None:
-        raise last_err
-    raise RuntimeError(f"Không lấy được media_info cho pk={pk} shortcode={shortcode!r}")
+            for round_i, delay in enumerate(delays):
+                await account.call(lambda: account.client.inject_sessionid_to_public())
+                pending = media_strategy_stats.order(list(_strategies(account)))
+                while pending:
+                    name = pending.pop(0)
+                    try:
+                        if Config.MEDIA_HEDGE_ENABLED:
+                            name, media = await _hedged(name, pending)
+                        else:
+                            media = await _attempt(name, account)
+                        if round_i:
+                            logger.info(f"Đã lấy media_info qua {name} sau {round_i} vòng retry")
+                        return media
+                    except Exception as e:
+                        if _is_fatal_media_error(e):
+                            # Thử nguồn khác trên cùng tài khoản chỉ làm tình hình tệ hơn
+                            raise
+                        last_err = e
+                        logger.debug(f"{name} thất bại (@{account.username}): {e}")
+                if round_i < len(delays) - 1 and last_err is not None and _is_json_parse_error(last_err):
+                    if not retry_budget.try_spend():
+                        logger.warning("Hết retry budget, dừng thử lại media_info")
+                        break
+                    metrics.json_retries.inc()
+                    logger.warning(
+                        f"Mọi nguồn media_info đều lỗi JSON (vòng {round_i + 1}/{len(delays)}), chờ {delay}s..."
+                    )
+                    with tracer.span("json_backoff", round=round_i + 1):
+                        await asyncio.sleep(delay)
+                    continue
+                break
+
+            if last_err is not None:
+                raise last_err
+            raise RuntimeError(f"Không lấy được media_info cho pk={pk} shortcode={shortcode!r}")
 
 
 def _latest_instagrapi_app_version() -> str:
@@ -175,23 +1985,221 @@ def _best_photo_url(media_info) -> str | None:
     return str(thumb) if thumb else None
 
 
-def init_instagram_client():
-    """Initialize Instagram client with login and session management."""
+def _best_video_url(media_info) -> tuple:
+    """(URL, width) của video chất lượng cao nhất: resources → video_versions → video_url."""
+    video_url = None
+    max_width = 0
+    
+    # Kiểm tra resources trước
+    if hasattr(media_info, 'resources') and media_info.resources:
+        for resource in media_info.resources:
+            if hasattr(resource, 'video_url') and resource.video_url:
+                if hasattr(resource, 'width') and resource.width > max_width:
+                    video_url = resource.video_url
+                    max_width = resource.width
+    
+    # Nếu không có trong resources, thử lấy từ video_versions
+    if not video_url and hasattr(media_info, 'video_versions'):
+        for version in media_info.video_versions:
+            if version.width > max_width:
+                video_url = version.url
+                max_width = version.width
+    
+    # Fallback to default video_url if still not found
+    if not video_url:
+        video_url = media_info.video_url
+    
+    return (str(video_url) if video_url else None), max_width
+
+
+@dataclass
+class MediaResource:
+    """Một item tải được của bài viết, với URL tốt nhất đã chọn sẵn."""
+    pk: str
+    media_type: int  # 1: ảnh, 2: video
+    url: str | None
+    width: int = 0
+
+
+@dataclass
+class MediaMeta:
+    """Các trường gọn của media_info mà pipeline cần; đủ nhỏ để lưu cache."""
+    pk: str
+    username: str
+    caption_text: str
+    taken_at: datetime
+    media_type: int
+    resources: list
+    video_url: str | None = None  # URL video mặc định, dùng cho đường tải dự phòng
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "pk": self.pk,
+            "username": self.username,
+            "caption_text": self.caption_text,
+            "taken_at": self.taken_at.isoformat(),
+            "media_type": self.media_type,
+            "resources": [vars(r) for r in self.resources],
+            "video_url": self.video_url,
+        })
+
+    @classmethod
+    def from_json(cls, data: str) -> "MediaMeta":
+        d = json.loads(data)
+        d["taken_at"] = datetime.fromisoformat(d["taken_at"])
+        d["resources"] = [MediaResource(**r) for r in d["resources"]]
+        return cls(**d)
+
+
+def compact_media(media_info) -> MediaMeta:
+    """Rút gọn instagrapi Media về MediaMeta."""
+    pk = str(media_info.pk)
+    if media_info.media_type == 8:
+        resources = [
+            MediaResource(
+                str(r.pk),
+                r.media_type,
+                str(r.video_url if r.media_type == 2 else r.thumbnail_url),
+            )
+            for r in media_info.resources
+        ]
+    elif media_info.media_type == 2:
+        resources = [MediaResource(pk, 2, *_best_video_url(media_info))]
+    else:
+        resources = [MediaResource(pk, media_info.media_type, _best_photo_url(media_info))]
+    return MediaMeta(
+        pk=pk,
+        username=media_info.user.username,
+        caption_text=media_info.caption_text or "",
+        taken_at=media_info.taken_at,
+        media_type=media_info.media_type,
+        resources=resources,
+        video_url=str(media_info.video_url) if media_info.video_url else None,
+    )
+
+
+def _cdn_url_expiry(url: str | None) -> float | None:
+    """URL scontent có tham số oe=<unix time dạng hex> là thời điểm URL hết hạn."""
+    if not url:
+        return None
+    oe = parse_qs(urlparse(url).query).get("oe")
+    try:
+        return float(int(oe[0], 16)) if oe else None
+    except ValueError:
+        return None
+
+
+class MediaMetaCache:
+    """
+    Cache bền (SQLite WAL) của MediaMeta theo media pk, đặt trước fetch_media_info_resilient.
+    Entry hết hạn sớm hơn URL CDN sớm nhất một khoảng an toàn, vì sau đó URL không tải được nữa.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS media_meta (
+                media_pk TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def get(self, media_pk: str) -> MediaMeta | None:
+        row = self._conn.execute(
+            "SELECT data, expires_at FROM media_meta WHERE media_pk = ?", (str(media_pk),)
+        ).fetchone()
+        if row is not None and row[1] <= time.time():
+            self.expired += 1
+            self._conn.execute("DELETE FROM media_meta WHERE media_pk = ?", (str(media_pk),))
+            self._conn.commit()
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return MediaMeta.from_json(row[0])
+
+    def put(self, meta: MediaMeta) -> None:
+        now = time.time()
+        expiries = [e for e in (_cdn_url_expiry(r.url) for r in meta.resources) if e]
+        if expiries:
+            expires_at = min(expiries) - Config.MEDIA_META_EXPIRY_MARGIN
+        else:
+            expires_at = now + Config.MEDIA_META_DEFAULT_TTL
+        if expires_at <= now:
+            return
+        self._conn.execute(
+            "INSERT OR REPLACE INTO media_meta VALUES (?, ?, ?, ?)",
+            (meta.pk, meta.to_json(), expires_at, now),
+        )
+        self._conn.commit()
+
+    def invalidate(self, media_pk: str) -> None:
+        self._conn.execute("DELETE FROM media_meta WHERE media_pk = ?", (str(media_pk),))
+        self._conn.commit()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "expired": self.expired}
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+media_meta_cache = MediaMetaCache(Config.MEDIA_META_CACHE_PATH)
+
+
+async def get_media_meta(media_pk: str, shortcode: str | None = None) -> MediaMeta:
+    """media_info dạng gọn; chỉ gọi Instagram khi cache miss hoặc URL CDN sắp hết hạn."""
+    meta = media_meta_cache.get(media_pk)
+    if meta is not None:
+        logger.info(f"Cache hit media_info cho {shortcode or media_pk}")
+        return meta
+    with metrics.stage_seconds.time(stage="media_info"), tracer.span("media_info", pk=str(media_pk)):
+        meta = compact_media(await fetch_media_info_resilient(media_pk, shortcode))
+    media_meta_cache.put(meta)
+    return meta
+
+
+def _reset_client(account: InstagramAccount) -> InstagramBotClient:
+    """Tạo client sạch cho tài khoản; giữ alias cl trỏ vào client của tài khoản chính."""
     global cl
+    # Chỉ gọi trong account.call (hoặc lúc khởi động): không lời gọi nào khác còn đang dùng client cũ
+    account.client = InstagramBotClient(request_timeout=0)
+    if account is client_pool.accounts[0]:
+        cl = account.client
+    return account.client
+
+def login_account(account: InstagramAccount, interactive: bool = False) -> bool:
+    """
+    Login one pool account with session management (session file + fingerprint riêng).
+    interactive: chỉ lúc khởi động mới được hỏi mã xác minh và chờ token login / hết rate limit; lúc bot
+    đang chạy thì pool đã lấy token login trước (InstagramClientPool._relogin), challenge/rate limit
+    được raise để pool loại hoặc cho tài khoản tạm nghỉ, không chiếm thread.
+    """
+    client = account.client
+    session_file = account.session_file
     try:
-        Config.validate()
-        session_file = "instagram_session.json"
-        
         # Thử load session cũ trước
         if os.path.exists(session_file):
             try:
-                cl.load_settings(session_file, override_app_version=True)
-                sync_instagrapi_fingerprint(cl, reset_device=False)
-                cl.account_info()  # Nhẹ hơn timeline/reels, tránh cold-start 400
-                logger.info("✅ Đã load session cũ thành công")
-                
-                # Thêm delay để tránh rate limit
-                time.sleep(2)
+                client.load_settings(session_file, override_app_version=True)
+                # Session cũ có thể lưu request_timeout=30 (giây ngủ trước mỗi request): bỏ đi
+                client.request_timeout = 0
+                sync_instagrapi_fingerprint(client, reset_device=False)
+                if interactive:
+                    account.limiter.acquire_sync("login")
+                client.account_info()  # Nhẹ hơn timeline/reels, tránh cold-start 400
+                logger.info(f"✅ Đã load session cũ thành công (@{account.username})")
                 return True
             except Exception as e:
                 logger.warning(f"⚠️ Session cũ không hợp lệ: {e}")
@@ -201,39 +2209,35 @@ def init_instagram_client():
                     pass
                 if _is_json_parse_error(e):
                     # Reset client state if previous session check got invalid JSON response
-                    cl = InstagramBotClient(request_timeout=30)
-                    cl.delay_range = [2, 5]
+                    client = _reset_client(account)
 
         # Nếu không có session hoặc session hết hạn, đăng nhập lại
         try:
             # Không hard-code Instagram 269.x — dùng DEVICE_SETTINGS + APP_SETTINGS của instagrapi đã cài
-            sync_instagrapi_fingerprint(cl, reset_device=True)
-            cl.delay_range = [2, 5]
+            sync_instagrapi_fingerprint(client, reset_device=True)
             logger.info(
                 "📱 Đang dùng fingerprint instagrapi: app %s",
                 _latest_instagrapi_app_version(),
             )
 
-            # Thêm delay trước khi đăng nhập
-            time.sleep(3)
+            # Chỉ chờ khi bucket login đã hết token
+            if interactive:
+                account.limiter.acquire_sync("login")
             
             # Thực hiện đăng nhập
-            login_response = cl.login(
-                username=Config.INSTAGRAM_USERNAME,
-                password=Config.INSTAGRAM_PASSWORD,
+            login_response = client.login(
+                username=account.username,
+                password=account.password,
                 relogin=True
             )
 
             if login_response:
                 # Lưu session mới
-                cl.dump_settings(session_file)
-                logger.info("✅ Đăng nhập và lưu session mới thành công")
-                
-                # Thêm delay sau khi đăng nhập
-                time.sleep(2)
+                client.dump_settings(session_file)
+                logger.info(f"✅ Đăng nhập và lưu session mới thành công (@{account.username})")
                 return True
             else:
-                logger.error("❌ Đăng nhập thất bại")
+                logger.error(f"❌ Đăng nhập thất bại (@{account.username})")
                 return False
 
         except Exception as e:
@@ -246,40 +2250,40 @@ def init_instagram_client():
                     pass
 
                 # Re-create a clean client state and retry once
-                cl = InstagramBotClient(request_timeout=30)
-                cl.delay_range = [2, 5]
+                client = _reset_client(account)
                 try:
-                    sync_instagrapi_fingerprint(cl, reset_device=True)
-                    cl.delay_range = [2, 5]
-                    time.sleep(3)
-                    login_response = cl.login(
-                        username=Config.INSTAGRAM_USERNAME,
-                        password=Config.INSTAGRAM_PASSWORD,
+                    sync_instagrapi_fingerprint(client, reset_device=True)
+                    if interactive:
+                        account.limiter.acquire_sync("login")
+                    login_response = client.login(
+                        username=account.username,
+                        password=account.password,
                         relogin=True
                     )
                     if login_response:
-                        cl.dump_settings(session_file)
+                        client.dump_settings(session_file)
                         logger.info("✅ Đăng nhập lại thành công sau khi reset client")
-                        time.sleep(2)
                         return True
                 except Exception as retry_error:
                     logger.error(f"❌ Đăng nhập lại thất bại: {retry_error}")
                 return False
+            if not interactive and (_is_challenge_error(e) or _is_rate_limit_error(e)):
+                raise
             if "challenge_required" in str(e):
                 try:
                     logger.info("🔐 Yêu cầu xác minh bảo mật...")
                     
                     # Chọn phương thức xác minh (0: SMS, 1: Email)
-                    choice = cl.challenge_resolve_choice()
+                    choice = client.challenge_resolve_choice()
                     if choice:
                         logger.info("✅ Đã chọn phương thức xác minh")
                     
                     # Nhập mã xác minh
                     code = input("📱 Nhập mã xác minh từ SMS/Email: ")
-                    cl.challenge_resolve(code)
+                    client.challenge_resolve(code)
                     
                     # Lưu session sau khi xác minh
-                    cl.dump_settings(session_file)
+                    client.dump_settings(session_file)
                     logger.info("✅ Xác minh và lưu session thành công")
                     return True
                     
@@ -289,41 +2293,51 @@ def init_instagram_client():
             elif "Please wait a few minutes before you try again" in str(e):
                 logger.warning("⚠️ Đã bị rate limit, đợi 15 phút và thử lại sau")
                 time.sleep(900)  # Đợi 15 phút
-                return init_instagram_client()  # Thử lại sau khi đợi
+                return login_account(account, interactive)  # Thử lại sau khi đợi
             else:
                 logger.error(f"❌ Lỗi đăng nhập: {e}")
                 return False
                 
+    except Exception as e:
+        if not interactive and (_is_challenge_error(e) or _is_rate_limit_error(e)):
+            raise
+        logger.error(f"❌ Lỗi khởi tạo client @{account.username}: {e}")
+        return False
+
+def init_instagram_client():
+    """Initialize every Instagram account in the pool; ready if at least one logged in."""
+    try:
+        Config.validate()
     except Exception as e:
         logger.error(f"❌ Lỗi khởi tạo client: {e}")
         return False
+    
+    ready = 0
+    for account in client_pool.accounts:
+        if login_account(account, interactive=True):
+            ready += 1
+        else:
+            client_pool.remove(account, "đăng nhập thất bại")
+    logger.info(f"✅ {ready}/{len(client_pool.accounts)} tài khoản Instagram sẵn sàng")
+    return ready > 0
 
-async def download_instagram_content(shortcode: str) -> list:
-    """Download Instagram content using instagrapi"""
+async def download_instagram_content(shortcode: str, retry_login: bool = True, partial: dict | None = None) -> list:
+    """
+    Download Instagram content using instagrapi.
+    partial: các item (theo index) đã tải xong ở lần chạy trước bị hoãn vì rate limit, không tải lại.
+    Instagram giới hạn truy cập thì raise RetryLater kèm các item đã tải được.
+    """
     media_files = []
+    partial = dict(partial or {})
+    media_pk = None
     try:
-        # Thêm delay ngẫu nhiên trước khi bắt đầu request để tránh rate limit
-        delay = random.uniform(3, 7)
-        await asyncio.sleep(delay)
-        
-        # Get media ID from shortcode
+        # Get media ID from shortcode (tính cục bộ, không gọi Instagram)
         media_pk = cl.media_pk_from_code(shortcode)
         
-        # Thêm delay giữa các request
-        await asyncio.sleep(2)
-        
         # Get media info
-        try:
-            media_info = await fetch_media_info_resilient(media_pk, shortcode)
-        except Exception as e:
-            if "Please wait a few minutes before you try again" in str(e):
-                logger.warning("⚠️ Rate limit khi lấy media info, đợi 15 phút và thử lại")
-                await asyncio.sleep(200)  # Đợi 3 phút
-                return await download_instagram_content(shortcode)
-            else:
-                raise e
+        media_info = await get_media_meta(media_pk, shortcode)
                 
-        username = media_info.user.username
+        username = media_info.username
         
         # Lấy caption và loại bỏ hashtag
         caption = media_info.caption_text if media_info.caption_text else "Không có caption"
@@ -351,99 +2365,66 @@ async def download_instagram_content(shortcode: str) -> list:
         os.makedirs(target_dir, exist_ok=True)
         
         if media_info.media_type == 1:  # Photo
-            try:
-                # Thêm delay trước khi download
-                await asyncio.sleep(2)
-                
-                # Không dùng photo_download(): bên trong gọi media_info() → GQL dễ JSON lỗi
-                photo_url = _best_photo_url(media_info)
-                if not photo_url:
-                    raise RuntimeError("Không có URL ảnh trong media_info")
-                fname = "{0}_{1}".format(username, media_pk)
-                photo_path = cl.photo_download_by_url(photo_url, fname, target_dir)
-                photo_path_str = str(photo_path)
-                media_files.append({
-                    "path": photo_path_str, 
-                    "type": "image",
-                    "username": username,  # Thêm username vào media_files
-                    "media_info": media_info  # Thêm toàn bộ media_info
-                })
-            except Exception as e:
-                if "Please wait a few minutes before you try again" in str(e):
-                    logger.warning("⚠️ Rate limit khi tải ảnh, đợi 15 phút và thử lại")
-                    await asyncio.sleep(200)  # Đợi 3 phút
-                    return await download_instagram_content(shortcode)
-                else:
-                    raise e
+            # Không dùng photo_download(): bên trong gọi media_info() → GQL dễ JSON lỗi
+            photo_url = media_info.resources[0].url
+            if not photo_url:
+                raise RuntimeError("Không có URL ảnh trong media_info")
+            fname = "{0}_{1}.{2}".format(username, media_pk, _url_extension(photo_url, "jpg"))
+            cache_key = resource_key(media_pk)
+            stats = await fetch_resource(
+                cache_key, photo_url, os.path.join(target_dir, fname), defer=_defer_download("image")
+            )
+            media_files.append({
+                "path": stats.path, 
+                **_deferred_fields(stats, cache_key, photo_url),
+                "type": "image",
+                "username": username,  # Thêm username vào media_files
+                "media_info": media_info,  # Thêm toàn bộ media_info
+                "index": 0
+            })
             
         elif media_info.media_type == 2:  # Video
             try:
-                # Thêm delay trước khi xử lý video
-                await asyncio.sleep(3)
-                
-                # Lấy URL video chất lượng cao nhất từ resources
-                video_url = None
-                max_width = 0
-                
-                # Kiểm tra resources trước
-                if hasattr(media_info, 'resources') and media_info.resources:
-                    for resource in media_info.resources:
-                        if hasattr(resource, 'video_url') and resource.video_url:
-                            if hasattr(resource, 'width') and resource.width > max_width:
-                                video_url = resource.video_url
-                                max_width = resource.width
-                
-                # Nếu không có trong resources, thử lấy từ video_versions
-                if not video_url and hasattr(media_info, 'video_versions'):
-                    for version in media_info.video_versions:
-                        if version.width > max_width:
-                            video_url = version.url
-                            max_width = version.width
-                
-                # Fallback to default video_url if still not found
-                if not video_url:
-                    video_url = media_info.video_url
+                # URL video chất lượng cao nhất đã được chọn khi rút gọn media_info
+                video_url = media_info.resources[0].url
+                max_width = media_info.resources[0].width
                 
                 if video_url:
                     file_name = f"{shortcode}.mp4"
                     file_path = os.path.join(target_dir, file_name)
-                    
-                    # Sử dụng aiohttp để tải video bất đồng bộ
-                    async with aiohttp.ClientSession() as session:
-                        async with session.get(video_url, timeout=60) as response:
-                            if response.status == 200:
-                                with open(file_path, 'wb') as f:
-                                    f.write(await response.read())
-                                media_files.append({
-                                    "path": file_path, 
-                                    "type": "video",
-                                    "username": username,
-                                    "media_info": media_info,
-                                    "quality": f"{max_width}p"  # Thêm thông tin độ phân giải
-                                })
-                                logger.info(f"Đã tải video chất lượng cao {max_width}p: {file_path}")
-                            else:
-                                raise Exception(f"Không thể tải video (HTTP {response.status})")
+                    cache_key = resource_key(media_pk)
+                    stats = await fetch_resource(cache_key, video_url, file_path, defer=_defer_download("video"))
+                    media_files.append({
+                        "path": stats.path, 
+                        **_deferred_fields(stats, cache_key, video_url),
+                        "type": "video",
+                        "username": username,
+                        "media_info": media_info,
+                        "index": 0,
+                        "quality": f"{max_width}p"  # Thêm thông tin độ phân giải
+                    })
+                    if stats.deferred:
+                        logger.info(f"Video {max_width}p hoãn tải tới lúc gửi: {shortcode}")
+                    else:
+                        logger.info(f"Đã tải video chất lượng cao {max_width}p: {stats.path}")
                 else:
                     raise Exception("Không tìm thấy URL video chất lượng cao")
                     
             except Exception as e:
-                if "Please wait a few minutes before you try again" in str(e):
-                    logger.warning("⚠️ Rate limit khi tải video, đợi 15 phút và thử lại")
-                    await asyncio.sleep(200)  # Đợi 3 phút
-                    return await download_instagram_content(shortcode)
-                
+                if isinstance(e, CircuitOpenError) or _is_rate_limit_error(e) or _is_cdn_throttled(e):
+                    raise
                 logger.error(f"Lỗi khi tải video chất lượng cao: {e}")
                 # Fallback: sử dụng phương thức tải thông thường
                 try:
-                    await asyncio.sleep(3)  # Thêm delay trước khi thử lại
                     if not media_info.video_url:
                         raise RuntimeError("Không có video_url trong media_info")
-                    video_path = cl.video_download_by_url(
-                        str(media_info.video_url),
-                        "{0}_{1}".format(username, media_pk),
-                        target_dir,
-                    )
+                    await rate_limiter.acquire("cdn")
+                    async with client_pool.lease() as account:
+                        video_path = await account.call(
+                            lambda: account.client.video_download_by_url(
+                                media_info.video_url, "{0}_{1}".format(username, media_pk), target_dir
+                            )
+                        )
                     if video_path and os.path.exists(str(video_path)):
                         new_path = os.path.join(target_dir, f"{shortcode}.mp4")
                         os.rename(str(video_path), new_path)
@@ -451,86 +2432,74 @@ async def download_instagram_content(shortcode: str) -> list:
                             "path": new_path,
                             "type": "video",
                             "username": username,
-                            "media_info": media_info
+                            "media_info": media_info,
+                            "index": 0
                         })
                         logger.info(f"Đã tải video dự phòng: {new_path}")
                 except Exception as backup_error:
-                    if "Please wait a few minutes before you try again" in str(backup_error):
-                        logger.warning("⚠️ Rate limit khi tải video dự phòng, đợi 15 phút và thử lại")
-                        await asyncio.sleep(200)  # Đợi 3 phút
-                        return await download_instagram_content(shortcode)
+                    if _is_rate_limit_error(backup_error):
+                        raise
                     logger.error(f"Lỗi khi tải video dự phòng: {backup_error}")
             
         elif media_info.media_type == 8:  # Album
-            try:
-                # Thêm delay trước khi download album
-                await asyncio.sleep(3)
-                
-                # Không dùng album_download(): bên trong gọi media_info() lại
-                album_files = []
-                for resource in media_info.resources:
-                    fn = f"{media_info.user.username}_{resource.pk}"
-                    if resource.media_type == 1:
-                        album_files.append(
-                            cl.photo_download_by_url(
-                                str(resource.thumbnail_url), fn, target_dir
-                            )
-                        )
-                    elif resource.media_type == 2:
-                        album_files.append(
-                            cl.video_download_by_url(
-                                str(resource.video_url), fn, target_dir
-                            )
-                        )
-                    else:
-                        raise RuntimeError(
-                            f"Kiểu media album không hỗ trợ: {resource.media_type}"
-                        )
-                
-                # Thêm delay giữa các file trong album
-                await asyncio.sleep(2)
-                
-                for file_path in album_files:
-                    file_path_str = str(file_path)
-                    if file_path_str.endswith('.mp4'):
-                        # Thử tải lại video với chất lượng cao
-                        try:
-                            video_url = media_info.video_url
-                            if video_url:
-                                # Sử dụng aiohttp để tải video bất đồng bộ
-                                async with aiohttp.ClientSession() as session:
-                                    async with session.get(video_url, timeout=60) as response:
-                                        if response.status == 200:
-                                            with open(file_path_str, 'wb') as f:
-                                                f.write(await response.read())
-                                            logger.info(f"Đã tải lại video album với chất lượng cao: {file_path_str}")
-                        except Exception as e:
-                            if "Please wait a few minutes before you try again" in str(e):
-                                # Không cần thử lại cả album, chỉ ghi log
-                                logger.warning(f"⚠️ Rate limit khi tải lại video album, bỏ qua: {file_path_str}")
-                            else:
-                                logger.error(f"Không thể tải lại video album chất lượng cao: {e}")
-                        
-                        media_files.append({
-                            "path": file_path_str, 
-                            "type": "video",
-                            "username": username,
-                            "media_info": media_info
-                        })
-                    else:
-                        media_files.append({
-                            "path": file_path_str, 
-                            "type": "image",
-                            "username": username,
-                            "media_info": media_info
-                        })
-            except Exception as e:
-                if "Please wait a few minutes before you try again" in str(e):
-                    logger.warning("⚠️ Rate limit khi tải album, đợi 15 phút và thử lại")
-                    await asyncio.sleep(200)  # Đợi 3 phút
-                    return await download_instagram_content(shortcode)
+            # Không dùng album_download(): bên trong gọi media_info() lại
+            # Tải song song các item, giới hạn số lượt tải đồng thời của một bài viết
+            post_semaphore = asyncio.Semaphore(Config.CAROUSEL_CONCURRENCY)
+            album_started = time.monotonic()
+            
+            async def _download_resource(index, resource):
+                done = partial.get(index)
+                if done and os.path.exists(done["path"]):
+                    logger.info(f"Item album {index + 1} đã tải ở lần chạy trước, dùng lại")
+                    return done
+                fn = f"{username}_{resource.pk}"
+                url = resource.url
+                if resource.media_type == 1:
+                    media_type = "image"
+                    file_name = f"{fn}.{_url_extension(url, 'jpg')}"
+                elif resource.media_type == 2:
+                    media_type = "video"
+                    file_name = f"{fn}.mp4"
                 else:
-                    raise e
+                    raise RuntimeError(
+                        f"Kiểu media album không hỗ trợ: {resource.media_type}"
+                    )
+                
+                cache_key = resource_key(media_pk, resource.pk)
+                async with post_semaphore:
+                    stats = await fetch_resource(
+                        cache_key, url, os.path.join(target_dir, file_name), defer=_defer_download(media_type)
+                    )
+                logger.info(
+                    f"Item album {index + 1}/{len(media_info.resources)} ({media_type}): "
+                    f"{stats.elapsed:.2f}s, {stats.size} bytes"
+                )
+                return {
+                    "path": stats.path, 
+                    **_deferred_fields(stats, cache_key, url),
+                    "type": media_type,
+                    "username": username,
+                    "media_info": media_info,
+                    "index": index,
+                    "download_time": stats.elapsed
+                }
+            
+            results = await asyncio.gather(
+                *(_download_resource(i, r) for i, r in enumerate(media_info.resources)),
+                return_exceptions=True
+            )
+            # Chờ mọi item xong rồi mới báo lỗi, tránh task mồ côi còn ghi file
+            for result in results:
+                if not isinstance(result, BaseException):
+                    partial[result["index"]] = result
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+            media_files.extend(results)
+            logger.info(
+                f"Đã tải album {len(results)} item trong {time.monotonic() - album_started:.2f}s "
+                f"(tổng thời gian từng item {sum(r['download_time'] for r in results):.2f}s)"
+            )
         
         logger.info(f"Downloaded {len(media_files)} files from {shortcode}")
         
@@ -538,33 +2507,61 @@ async def download_instagram_content(shortcode: str) -> list:
         valid_files = []
         for media_file in media_files:
             file_path = media_file["path"]
-            if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+            if media_file.get("source_url"):
+                valid_files.append(media_file)
+            elif os.path.exists(file_path) and os.path.getsize(file_path) > 0:
                 valid_files.append(media_file)
                 logger.info(f"Verified file: {file_path}")
             else:
                 logger.error(f"Invalid or empty file: {file_path}")
         
+        if not valid_files:
+            # URL CDN trong cache có thể đã bị thu hồi sớm: lần sau lấy media_info mới
+            media_meta_cache.invalidate(media_pk)
+        
+        for media_file in valid_files:
+            media_file["media_pk"] = str(media_pk)
+        
         # Thêm thông tin bài viết vào media_files đầu tiên
         if valid_files:
             valid_files[0]["post_info"] = post_info
+            # Số item thật của bài viết, để cache chỉ được coi là đủ khi đã gửi hết
+            valid_files[0]["item_count"] = len(media_info.resources) if media_info.media_type == 8 else 1
         
         return valid_files
     
     except LoginRequired:
-        logger.error("Login required, trying to re-login")
-        if init_instagram_client():
-            # Thêm delay trước khi thử lại
-            await asyncio.sleep(5)
+        # Pool đã đăng nhập lại (hoặc loại) tài khoản vừa dùng
+        logger.error("Login required, tài khoản đã được đăng nhập lại")
+        if retry_login and retry_budget.try_spend():
             # Retry once after re-login
-            return await download_instagram_content(shortcode)
+            return await download_instagram_content(shortcode, retry_login=False, partial=partial)
         return []
+    except AccountsUnavailable as e:
+        if e.retry_after is None:
+            raise
+        raise RetryLater(e.retry_after, partial) from e
+    except RetryLater:
+        raise
+    except CircuitOpenError:
+        _discard_partial(partial)
+        raise
     except Exception as e:
-        if "Please wait a few minutes before you try again" in str(e):
-            logger.warning("⚠️ Rate limit ở cấp độ function, đợi 15 phút và thử lại")
-            await asyncio.sleep(200)  # Đợi 3 phút
-            return await download_instagram_content(shortcode)
+        if _is_rate_limit_error(e):
+            # Không ngủ trong handler: job được hoãn tới khi tài khoản hết thời gian nghỉ
+            logger.warning(f"⚠️ Rate limit khi tải {shortcode}, hoãn job ({len(partial)} item đã tải)")
+            raise RetryLater(client_pool.retry_after(), partial) from e
+        if _is_cdn_throttled(e):
+            # CDN giới hạn tốc độ: hoãn job, giữ các item album đã tải xong cho lần chạy sau
+            logger.warning(f"⚠️ CDN giới hạn khi tải {shortcode}, hoãn job ({len(partial)} item đã tải)")
+            raise RetryLater(e.retry_after, partial) from e
             
         logger.error(f"Error downloading content: {e}")
+        # Job không chạy lại: xoá các item album đã tải (file trong cache đĩa được giữ)
+        _discard_partial(partial)
+        if media_pk is not None:
+            # CDN từ chối / lỗi kết nối: URL trong cache có thể đã bị thu hồi sớm, lần sau lấy media_info mới
+            media_meta_cache.invalidate(media_pk)
         return []
 
 async def download_instagram_story(username: str, story_id: str = None) -> list:
@@ -572,16 +2569,21 @@ async def download_instagram_story(username: str, story_id: str = None) -> list:
     media_files = []
     processed_ids = set()
     try:
-        # Lấy user ID từ username
-        user_id = cl.user_id_from_username(username)
+        with circuit_breakers["stories"].guard():
+            retry_budget.on_request()
+            async with client_pool.lease() as account:
+                # Lấy user ID từ username
+                await account.limiter.acquire("stories")
+                user_id = await account.call(lambda: account.client.user_id_from_username(username))
+                
+                # Lấy danh sách stories
+                await account.limiter.acquire("stories")
+                stories = await account.call(lambda: account.client.user_stories(user_id))
         
         # Tạo thư mục cho stories
         target_dir = os.path.join(DOWNLOAD_DIR, f"stories_{username}")
         os.makedirs(target_dir, exist_ok=True)
         
-        # Lấy danh sách stories
-        stories = cl.user_stories(user_id)
-        
         if not stories:
             logger.error(f"Không tìm thấy story nào của {username}")
             return []
@@ -591,6 +2593,7 @@ async def download_instagram_story(username: str, story_id: str = None) -> list:
         # Sắp xếp stories theo thời gian để tải theo thứ tự
         sorted_stories = sorted(stories, key=lambda x: x.taken_at)
         
+        pending = []
         for story in sorted_stories:
             # Nếu có story_id cụ thể, chỉ tải story đó
             if story_id and str(story.pk) != story_id:
@@ -603,71 +2606,94 @@ async def download_instagram_story(username: str, story_id: str = None) -> list:
                 
             processed_ids.add(story.pk)
             
+            # Story đã gửi trước đó: dùng lại file_id, không tải lại
+            cached = file_id_cache.get_item(story.pk)
+            if cached:
+                cached.update({"taken_at": story.taken_at, "username": username})
+                media_files.append(cached)
+                logger.info(f"Story {story.pk} đã có file_id trong cache, bỏ qua tải xuống")
+                continue
+            
+            if story.media_type in (1, 2):
+                pending.append(story)
+        
+        # Tải song song các story, giới hạn số lượt tải đồng thời của một user
+        story_semaphore = asyncio.Semaphore(Config.STORY_CONCURRENCY)
+        stories_started = time.monotonic()
+        
+        async def _download_story(story):
+            is_video = story.media_type == 2
+            timestamp = story.taken_at.strftime("%Y%m%d_%H%M%S")
+            file_name = f"story_{username}_{timestamp}_{story.pk}.{'mp4' if is_video else 'jpg'}"
+            file_path = os.path.join(target_dir, file_name)
+            item = {
+                "type": "video" if is_video else "image",
+                "taken_at": story.taken_at,
+                "username": username,
+                "media_pk": str(story.pk),
+                "index": 0
+            }
+            
+            if os.path.exists(file_path):
+                # File do lượt tải story khác của cùng tài khoản tạo ra: dùng lại, không bỏ sót
+                logger.info(f"File {file_name} đã tồn tại, dùng lại")
+                return {"path": _pin_existing(file_path), **item}
+            
+            # URL chất lượng cao nhất của ảnh / video
+            url = story.video_url if is_video else story.thumbnail_url
+            if not url:
+                return None
+            
             try:
-                timestamp = story.taken_at.strftime("%Y%m%d_%H%M%S")
-                
-                if story.media_type == 1:  # Photo
-                    file_name = f"story_{username}_{timestamp}_{story.pk}.jpg"
-                    file_path = os.path.join(target_dir, file_name)
-                    
-                    if os.path.exists(file_path):
-                        logger.info(f"File {file_name} đã tồn tại, bỏ qua")
-                        continue
-                    
-                    # Lấy URL chất lượng cao nhất cho ảnh
-                    photo_url = story.thumbnail_url_info()[-1]['url']
-                    response = requests.get(photo_url)
-                    if response.status_code == 200:
-                        with open(file_path, 'wb') as f:
-                            f.write(response.content)
-                        media_files.append({
-                            "path": file_path,
-                            "type": "image",
-                            "taken_at": story.taken_at,
-                            "username": username
-                        })
-                        logger.info(f"Đã tải story ảnh chất lượng cao: {story.pk} - {file_name}")
-                    
-                elif story.media_type == 2:  # Video
-                    file_name = f"story_{username}_{timestamp}_{story.pk}.mp4"
-                    file_path = os.path.join(target_dir, file_name)
-                    
-                    if os.path.exists(file_path):
-                        logger.info(f"File {file_name} đã tồn tại, bỏ qua")
-                        continue
-                    
-                    # Lấy URL video chất lượng cao nhất
-                    video_url = story.video_url
-                    response = requests.get(video_url)
-                    if response.status_code == 200:
-                        with open(file_path, 'wb') as f:
-                            f.write(response.content)
-                        media_files.append({
-                            "path": file_path,
-                            "type": "video",
-                            "taken_at": story.taken_at,
-                            "username": username
-                        })
-                        logger.info(f"Đã tải story video chất lượng cao: {story.pk} - {file_name}")
+                key = resource_key(story.pk)
+                async with story_semaphore:
+                    stats = await fetch_resource(
+                        key, url, file_path, defer=_defer_download(item["type"]),
+                        timeout=Config.STORY_DOWNLOAD_TIMEOUT
+                    )
+                logger.info(f"Đã tải story {item['type']} chất lượng cao: {story.pk} - {file_name} ({stats.elapsed:.2f}s)")
+                return {"path": stats.path, **_deferred_fields(stats, key, url), **item}
                     
             except Exception as e:
+                if isinstance(e, CircuitOpenError) or _is_cdn_throttled(e):
+                    # CDN đang sự cố / giới hạn: báo lỗi ngay, không tải dự phòng (thêm request story_info + CDN ngoài breaker)
+                    raise
                 logger.error(f"Lỗi khi tải story {story.pk}: {e}")
                 # Nếu tải chất lượng cao thất bại, thử tải bằng phương thức thông thường
                 try:
-                    story_path = cl.story_download(story.pk, folder=target_dir)
+                    with circuit_breakers["stories"].guard():
+                        async with client_pool.lease() as account:
+                            await account.limiter.acquire("stories")
+                            os.makedirs(target_dir, exist_ok=True)
+                            story_path = await account.call(
+                                lambda: account.client.story_download(story.pk, folder=target_dir)
+                            )
                     if story_path and os.path.exists(str(story_path)):
                         new_path = os.path.join(target_dir, file_name)
                         os.rename(str(story_path), new_path)
-                        media_files.append({
-                            "path": new_path,
-                            "type": "video" if story.media_type == 2 else "image",
-                            "taken_at": story.taken_at,
-                            "username": username
-                        })
                         logger.info(f"Đã tải story dự phòng: {story.pk} - {file_name}")
+                        return {"path": new_path, **item}
                 except Exception as backup_error:
                     logger.error(f"Lỗi khi tải story dự phòng {story.pk}: {backup_error}")
-                continue
+                return None
+        
+        async def _download_story_once(story):
+            # Lượt "story:<user>:*" và "story:<user>:<id>" có thể chạy cùng lúc: mỗi story chỉ tải một lần
+            async def _fetch():
+                result = await _download_story(story)
+                return [result] if result else []
+
+            items = await _nested_flight(f"story_item:{story.pk}", _fetch)
+            return items[0] if items else None
+
+        results = await asyncio.gather(*(_download_story_once(story) for story in pending), return_exceptions=True)
+        # Chờ mọi story xong rồi mới báo lỗi, tránh task mồ côi còn ghi file
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        media_files.extend(result for result in results if result)
+        if pending:
+            logger.info(f"Đã tải {len(pending)} story của {username} trong {time.monotonic() - stories_started:.2f}s")
         
         # Sắp xếp media_files theo thời gian đăng
         media_files.sort(key=lambda x: x["taken_at"])
@@ -675,6 +2701,9 @@ async def download_instagram_story(username: str, story_id: str = None) -> list:
         # Kiểm tra và xác thực các file đã tải
         valid_files = []
         for media_file in media_files:
+            if media_file.get("file_id") or media_file.get("source_url"):
+                valid_files.append(media_file)
+                continue
             file_path = media_file["path"]
             if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
                 valid_files.append(media_file)
@@ -684,35 +2713,606 @@ async def download_instagram_story(username: str, story_id: str = None) -> list:
         
         return valid_files
         
+    except AccountsUnavailable as e:
+        if e.retry_after is None:
+            raise
+        raise RetryLater(e.retry_after) from e
+    except CircuitOpenError:
+        raise
     except Exception as e:
+        if _is_rate_limit_error(e):
+            raise RetryLater(client_pool.retry_after()) from e
+        if _is_cdn_throttled(e):
+            raise RetryLater(e.retry_after) from e
         logger.error(f"Lỗi khi tải stories: {e}")
         return []
 
+# Giới hạn của Bot API
+MEDIA_GROUP_LIMIT = 10
+CAPTION_LIMIT = 1024
+PHOTO_UPLOAD_LIMIT = 10 * 1024 * 1024
+FILE_UPLOAD_LIMIT = 50 * 1024 * 1024
+
+async def send_single_media(update: Update, media_item: dict, filename: str, caption: str):
+    """Gửi một media: dùng file_id nếu đã có, không thì upload file trên đĩa dạng document."""
+    file_id = media_item.get("file_id")
+    if file_id:
+        kind = media_item.get("kind", "document")
+        if kind == "photo":
+            return await update.message.reply_photo(photo=file_id, caption=caption, read_timeout=60, connect_timeout=60)
+        if kind == "video":
+            return await update.message.reply_video(video=file_id, caption=caption, read_timeout=60, connect_timeout=60)
+        return await update.message.reply_document(
+            document=file_id,
+            caption=caption,
+            read_timeout=60,
+            connect_timeout=60
+        )
+    
+    if _is_remote(media_item) and Config.TELEGRAM_SEND_BY_URL and not media_item.get("url_rejected"):
+        try:
+            return await send_by_url(update, media_item, caption)
+        except BadRequest as url_error:
+            # Telegram không lấy được URL (quá 5MB/20MB, CDN chặn...): tự tải rồi upload
+            logger.warning(f"Telegram từ chối URL của {filename}, tải về rồi upload: {url_error}")
+            media_item["url_rejected"] = True
+    
+    if _is_remote(media_item) and Config.TELEGRAM_PIPE_MODE and media_item["type"] == "video":
+        try:
+            return await pipe_document(update, media_item, filename, caption)
+        except Exception as pipe_error:
+            if isinstance(pipe_error, CircuitOpenError):
+                raise
+            # Byte đã stream không giữ lại: tải về đĩa rồi gửi lại như thường
+            logger.warning(f"Pipe {filename} thất bại, tải về đĩa rồi gửi lại: {pipe_error}")
+    
+    await ensure_local(media_item)
+    is_video = media_item["type"] == "video"
+    timeout = 300 if is_video else 120
+    extra = {"disable_content_type_detection": True} if is_video else {}
+    with open(media_item["path"], 'rb') as file:
+        return await update.message.reply_document(
+            document=file,
+            filename=filename,
+            caption=caption,
+            read_timeout=timeout,
+            write_timeout=timeout,
+            connect_timeout=60,
+            **extra
+        )
+
+async def send_by_url(update: Update, media_item: dict, caption: str):
+    """Gửi ảnh/video bằng URL CDN, Telegram tự tải (ảnh tối đa 5MB, video 20MB)."""
+    url = media_item["source_url"]
+    with tracer.span("send_by_url", type=media_item["type"]):
+        if media_item["type"] == "video":
+            message = await update.message.reply_video(
+                video=url, caption=caption, supports_streaming=True, read_timeout=120, connect_timeout=60
+            )
+        else:
+            message = await update.message.reply_photo(photo=url, caption=caption, read_timeout=120, connect_timeout=60)
+    logger.info(f"Telegram đã tự tải {media_item['type']} từ URL CDN")
+    return message
+
+async def pipe_document(update: Update, media_item: dict, filename: str, caption: str):
+    """
+    Gửi media dạng document mà không ghi đĩa: body từ CDN được stream thẳng vào multipart
+    sendDocument qua hàng đợi tối đa TELEGRAM_PIPE_BUFFER_CHUNKS chunk.
+    Lỗi ở CDN hay Bot API đều raise, người gọi tự tải về đĩa và gửi lại.
+    """
+    message = update.message
+    buffer = asyncio.Queue(maxsize=max(1, Config.TELEGRAM_PIPE_BUFFER_CHUNKS))
+    errors = []
+    headers_ready = asyncio.Event()
+    sent = 0
+
+    async def _pump():
+        received = 0
+        try:
+            await rate_limiter.acquire("cdn")
+            async with cdn_download_semaphore:
+                with circuit_breakers["cdn"].guard():
+                    async with get_http_session().get(
+                        str(media_item["source_url"]),
+                        timeout=aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=60),
+                    ) as response:
+                        if response.status != 200:
+                            raise CdnStatusError(response.status, f"Không thể tải {filename} (HTTP {response.status})")
+                        expected = None if response.headers.get("Content-Encoding") else response.content_length
+                        headers_ready.set()
+                        async for chunk in response.content.iter_chunked(Config.DOWNLOAD_CHUNK_SIZE):
+                            await buffer.put(chunk)
+                            received += len(chunk)
+                        if expected is not None and received != expected:
+                            raise Exception(f"Tải thiếu {filename}: {received}/{expected} bytes")
+        except Exception as e:
+            errors.append(e)
+        finally:
+            metrics.downloaded_bytes.inc(received)
+            headers_ready.set()
+        await buffer.put(None)
+
+    async def _body():
+        nonlocal sent
+        while (chunk := await buffer.get()) is not None:
+            sent += len(chunk)
+            yield chunk
+        if errors:
+            # Không gửi boundary cuối: Telegram nhận body dở dang và bỏ request
+            raise errors[0]
+
+    fields = {"chat_id": str(message.chat_id)}
+    if caption:
+        fields["caption"] = caption
+    if media_item["type"] == "video":
+        fields["disable_content_type_detection"] = "true"
+    if message.chat.type != Chat.PRIVATE:
+        # Như reply_document: chỉ trích dẫn tin nhắn gốc trong nhóm
+        fields["reply_parameters"] = json.dumps({"message_id": message.message_id})
+    form = aiohttp.MultipartWriter("form-data")
+    for name, value in fields.items():
+        form.append(value).set_content_disposition("form-data", name=name)
+    form.append_payload(aiohttp.payload.AsyncIterablePayload(
+        _body(), content_type=mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    )).set_content_disposition("form-data", name="document", filename=filename)
+
+    pump = asyncio.ensure_future(_pump())
+    try:
+        # CDN trả lỗi ngay (403, 5xx...) thì chưa mở request upload nào
+        await headers_ready.wait()
+        if errors:
+            raise errors[0]
+        with tracer.span("pipe_upload", file=filename) as span:
+            try:
+                async with get_http_session().post(
+                    f"{update.get_bot().base_url}/sendDocument",
+                    data=form,
+                    timeout=aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=300),
+                ) as response:
+                    result = await response.json(content_type=None)
+            except Exception:
+                if errors:
+                    raise errors[0]
+                raise
+            span.attrs["bytes"] = sent
+    finally:
+        pump.cancel()
+    if not result.get("ok"):
+        raise TelegramError(result.get("description") or f"sendDocument HTTP {response.status}")
+    media_item["size"] = sent
+    logger.info(f"Đã gửi kiểu pipe {filename}: {sent} bytes")
+    return Message.de_json(result["result"], update.get_bot())
+
+def _media_group_eligible(media_item: dict) -> bool:
+    """Item có thể nằm trong media group: ảnh/video dưới giới hạn upload, hoặc file_id ảnh/video."""
+    if media_item.get("file_id"):
+        return media_item.get("kind") in ("photo", "video")
+    if _is_remote(media_item):
+        # Kích thước chưa biết: chỉ gom nhóm khi gửi bằng URL, Telegram từ chối thì gửi lẻ
+        return Config.TELEGRAM_SEND_BY_URL and not media_item.get("url_rejected")
+    limit = PHOTO_UPLOAD_LIMIT if media_item["type"] == "image" else FILE_UPLOAD_LIMIT
+    return os.path.getsize(media_item["path"]) <= limit
+
+def _sent_file_id(message) -> tuple:
+    """(kind, file_id) của media trong tin nhắn Telegram vừa gửi."""
+    if message.photo:
+        return "photo", message.photo[-1].file_id
+    if message.video:
+        return "video", message.video.file_id
+    if message.document:
+        return "document", message.document.file_id
+    return None, None
+
+async def send_media_group_batch(update: Update, batch: list) -> tuple:
+    """Gửi tối đa 10 item trong một lần gọi send_media_group, trả về các Message theo thứ tự."""
+    with ExitStack() as stack:
+        media = []
+        for entry in batch:
+            media_item = entry["item"]
+            if media_item.get("file_id"):
+                source = media_item["file_id"]
+            elif _is_remote(media_item):
+                source = media_item["source_url"]
+            else:
+                source = stack.enter_context(open(media_item["path"], 'rb'))
+            if media_item["type"] == "video":
+                media.append(InputMediaVideo(
+                    media=source,
+                    caption=entry["caption"],
+                    filename=entry["filename"],
+                    supports_streaming=True
+                ))
+            else:
+                media.append(InputMediaPhoto(
+                    media=source,
+                    caption=entry["caption"],
+                    filename=entry["filename"]
+                ))
+        return await update.message.reply_media_group(
+            media=media,
+            read_timeout=300,
+            write_timeout=300,
+            connect_timeout=60
+        )
+
+def _upload_size(media_item: dict) -> int:
+    """Số byte thật sự upload lên Telegram (0 khi gửi lại bằng file_id)."""
+    if media_item.get("file_id") or not media_item.get("path"):
+        return 0
+    try:
+        return os.path.getsize(media_item["path"])
+    except OSError:
+        # Gửi kiểu pipe: không có file, số byte đã stream nằm trong item
+        return media_item.get("size", 0)
+
+async def deliver_media_items(update: Update, prepared: list) -> list:
+    """
+    Gửi các item đã chuẩn bị (item, filename, caption). Ở chế độ media_group, gom tối đa 10 item
+    mỗi lần gọi Bot API; item quá lớn hoặc batch bị Telegram từ chối thì gửi từng file dạng document.
+    Trả về list (media_item, kind, file_id) của các item đã gửi thành công.
+    """
+    delivered = []
+    fallback = prepared
+    
+    if Config.TELEGRAM_DELIVERY_MODE == "media_group" and len(prepared) > 1:
+        groupable = []
+        fallback = []
+        for entry in prepared:
+            (groupable if _media_group_eligible(entry["item"]) else fallback).append(entry)
+        
+        for start in range(0, len(groupable), MEDIA_GROUP_LIMIT):
+            batch = groupable[start:start + MEDIA_GROUP_LIMIT]
+            if len(batch) < 2:
+                # send_media_group cần ít nhất 2 item
+                fallback.extend(batch)
+                continue
+            try:
+                with metrics.stage_seconds.time(stage="telegram_upload"), tracer.span("telegram_upload", items=len(batch)):
+                    messages = await send_media_group_batch(update, batch)
+                metrics.uploaded_bytes.inc(sum(_upload_size(entry["item"]) for entry in batch))
+                for entry, message in zip(batch, messages):
+                    delivered.append((entry["item"], *_sent_file_id(message)))
+                logger.info(f"Đã gửi media group {len(batch)} item")
+            except Exception as group_error:
+                logger.warning(f"Telegram từ chối media group ({len(batch)} item), gửi lại dạng document: {group_error}")
+                for entry in batch:
+                    # Không biết URL nào bị từ chối: gửi lẻ thì tự tải rồi upload
+                    if _is_remote(entry["item"]):
+                        entry["item"]["url_rejected"] = True
+                fallback.extend(batch)
+        fallback.sort(key=lambda entry: entry["position"])
+    
+    for entry in fallback:
+        media_item = entry["item"]
+        try:
+            with metrics.stage_seconds.time(stage="telegram_upload"), tracer.span("telegram_upload", items=1):
+                sent = await send_single_media(update, media_item, entry["filename"], entry["caption"])
+            metrics.uploaded_bytes.inc(_upload_size(media_item))
+            delivered.append((media_item, *_sent_file_id(sent)))
+            logger.info(f"Đã gửi thành công {media_item['type']} {entry['position'] + 1}")
+        except Exception as send_error:
+            logger.error(f"Lỗi khi gửi file {media_item.get('path') or media_item.get('file_id')}: {send_error}")
+    
+    return delivered
+
+@dataclass
+class DownloadJob:
+    """Một URL người dùng gửi; giữ trạng thái qua các lần hoãn vì rate limit."""
+    update: Update
+    url: str
+    processing_message: object
+    attempts: int = 0
+    partial: dict = field(default_factory=dict)
+    enqueued_at: float = 0.0
+    created_at: float = field(default_factory=time.monotonic)
+    trace: Span | None = None
+
+
+class DelayedRetryScheduler:
+    """
+    Hàng đợi hoãn cho job bị rate limit: job được cất lại cùng trạng thái và chạy lại thành task
+    mới khi tài khoản hết thời gian nghỉ, handler không giữ tài nguyên trong lúc chờ.
+    """
+
+    def __init__(self):
+        self._parked = {}  # id(job) -> (job, resume_at, TimerHandle)
+        self._tasks = set()
+        self.parked_total = 0
+        self.resumed = 0
+
+    def park(self, job: DownloadJob, delay: float, run) -> float:
+        """Hẹn chạy lại run(job) sau delay giây; trả về thời điểm (epoch) chạy lại."""
+        delay = max(1.0, delay)
+        job.attempts += 1
+        resume_at = time.time() + delay
+        handle = asyncio.get_running_loop().call_later(delay, self._resume, job, run)
+        self._parked[id(job)] = (job, resume_at, handle)
+        self.parked_total += 1
+        logger.info(f"Hoãn job {job.url} {delay:.0f}s (lần {job.attempts})")
+        return resume_at
+
+    def _resume(self, job: DownloadJob, run) -> None:
+        self._parked.pop(id(job), None)
+        self.resumed += 1
+        task = asyncio.ensure_future(run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def cancel_all(self) -> None:
+        for job, _, handle in self._parked.values():
+            handle.cancel()
+            _discard_partial(job.partial)
+        self._parked.clear()
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {
+            "parked": len(self._parked),
+            "running": len(self._tasks),
+            "parked_total": self.parked_total,
+            "resumed": self.resumed,
+            "next_resume_in": min((r - now for _, r, _ in self._parked.values()), default=None),
+        }
+
+
+def _discard_partial(partial: dict) -> None:
+    """Xoá file của các item đã tải dở khi job bị bỏ hẳn (trừ file đang được lượt gửi khác dùng)."""
+    media_leases.release([
+        item["path"] for item in partial.values()
+        if item.get("path") and not media_leases.in_use(item["path"])
+    ])
+
+
+delayed_retries = DelayedRetryScheduler()
+
+
+class JobQueue:
+    """
+    Hàng đợi job + số worker async cố định: handler Telegram chỉ xếp job rồi trả lời ngay,
+    việc tải / gửi chạy trong worker nên số job chạy đồng thời luôn bị chặn trên.
+    Mỗi chat có hàng đợi riêng, worker lấy job theo deficit round-robin (chat ưu tiên được
+    trọng số cao hơn), mỗi chat chạy tối đa max_in_flight job cùng lúc và có quota token bucket.
+    """
+
+    def __init__(self, workers: int, max_size: int, max_in_flight: int, user_rate: str):
+        self.workers = workers
+        self.max_size = max_size
+        self.max_in_flight = max_in_flight
+        self.user_rate = _parse_rate(user_rate)
+        self._queues = {}  # chat_id -> deque[DownloadJob]
+        self._active = deque()  # chat_id có job chờ, theo thứ tự vòng
+        self._deficit = {}
+        self._in_flight = {}
+        self._quotas = {}  # chat_id -> TokenBucket
+        self._quota_prune_at = 1024
+        self._depth = 0
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self.busy = 0
+        self.processed = 0
+        self.rejected = 0
+        self.quota_rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_service = 0.0
+
+    @staticmethod
+    def _chat_id(job: DownloadJob) -> int:
+        return job.update.effective_chat.id
+
+    @staticmethod
+    def _weight(chat_id: int) -> int:
+        return Config.PRIORITY_CHAT_WEIGHT if chat_id in Config.PRIORITY_CHAT_IDS else 1
+
+    def start(self, run) -> None:
+        self._tasks = [asyncio.ensure_future(self._worker(run)) for _ in range(self.workers)]
+        logger.info(f"Đã chạy {self.workers} worker xử lý URL")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def full(self) -> bool:
+        """True (và tính là một lần từ chối) nếu hàng đợi đã đầy."""
+        if self.max_size and self._depth >= self.max_size:
+            self.rejected += 1
+            return True
+        return False
+
+    def quota_wait(self, chat_id: int) -> float:
+        """Lấy một lượt trong quota của chat; trả về số giây phải đợi nếu chat đã hết quota."""
+        bucket = self._quotas.get(chat_id)
+        if bucket is None:
+            if len(self._quotas) >= self._quota_prune_at:
+                self._prune_quotas()
+            bucket = self._quotas[chat_id] = TokenBucket(*self.user_rate)
+        wait = bucket.try_reserve()
+        if wait:
+            self.quota_rejected += 1
+        return wait
+
+    def _prune_quotas(self) -> None:
+        """Bỏ quota của các chat đã hồi đầy token; ngưỡng dọn lần sau tăng theo số chat còn lại (O(1) khấu hao)."""
+        for chat_id in [c for c, bucket in self._quotas.items() if bucket.full()]:
+            del self._quotas[chat_id]
+        self._quota_prune_at = max(1024, 2 * len(self._quotas))
+
+    def position(self, chat_id: int) -> int:
+        """
+        Ước lượng vị trí của job tiếp theo của chat nếu xếp lúc này (0: chạy ngay). Trước job thứ
+        n của chat, mỗi chat khác được phục vụ tối đa n * trọng số của nó / trọng số của chat này.
+        """
+        n = len(self._queues.get(chat_id, ())) + 1
+        ahead = n - 1
+        for other, queue in self._queues.items():
+            if other != chat_id:
+                ahead += min(len(queue), -(-n * self._weight(other) // self._weight(chat_id)))
+        if self._in_flight.get(chat_id, 0) >= self.max_in_flight:
+            ahead += 1
+        return max(0, ahead - (self.workers - self.busy) + 1)
+
+    def submit(self, job: DownloadJob) -> None:
+        """Xếp job mới vào hàng đợi của chat gửi nó."""
+        chat_id = self._chat_id(job)
+        job.enqueued_at = time.monotonic()
+        queue = self._queues.setdefault(chat_id, deque())
+        if not queue:
+            self._active.append(chat_id)
+        queue.append(job)
+        self._depth += 1
+        self._wakeup.set()
+
+    async def requeue(self, job: DownloadJob) -> None:
+        """Xếp lại job đã hoãn; không tính giới hạn hàng đợi hay quota vì job đã được nhận từ trước."""
+        self.submit(job)
+
+    def _pick(self) -> DownloadJob | None:
+        """Deficit round-robin (chi phí mỗi job là 1) qua các chat có job chờ và còn slot chạy."""
+        for _ in range(len(self._active)):
+            chat_id = self._active[0]
+            if self._in_flight.get(chat_id, 0) >= self.max_in_flight:
+                self._active.rotate(-1)
+                continue
+            if self._deficit.get(chat_id, 0) < 1:
+                self._deficit[chat_id] = self._deficit.get(chat_id, 0) + self._weight(chat_id)
+            queue = self._queues[chat_id]
+            job = queue.popleft()
+            self._depth -= 1
+            self._deficit[chat_id] -= 1
+            if not queue:
+                # Hết job: bỏ khỏi vòng, không giữ phần deficit dư
+                self._active.popleft()
+                del self._queues[chat_id]
+                self._deficit.pop(chat_id, None)
+            elif self._deficit[chat_id] < 1:
+                self._active.rotate(-1)
+            return job
+        return None
+
+    async def _worker(self, run) -> None:
+        while True:
+            job = self._pick()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            chat_id = self._chat_id(job)
+            wait = time.monotonic() - job.enqueued_at
+            self._in_flight[chat_id] = self._in_flight.get(chat_id, 0) + 1
+            self.busy += 1
+            started = time.monotonic()
+            try:
+                await run(job)
+            except Exception as e:
+                logger.error(f"Worker lỗi khi xử lý {job.url}: {e}")
+            finally:
+                self.busy -= 1
+                left = self._in_flight[chat_id] - 1
+                if left:
+                    self._in_flight[chat_id] = left
+                else:
+                    del self._in_flight[chat_id]
+                self.processed += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.total_service += time.monotonic() - started
+                # Chat vừa trả slot có thể còn job chờ
+                self._wakeup.set()
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "busy": self.busy,
+            "depth": self._depth,
+            "chats_waiting": len(self._active),
+            "chats_running": len(self._in_flight),
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "quota_rejected": self.quota_rejected,
+            "quota_chats": len(self._quotas),
+            "avg_wait": self.total_wait / self.processed if self.processed else 0.0,
+            "max_wait": self.max_wait,
+            "avg_service": self.total_service / self.processed if self.processed else 0.0,
+            "top_chats": sorted(
+                ((chat_id, len(q)) for chat_id, q in self._queues.items()),
+                key=lambda item: -item[1],
+            )[:5],
+        }
+
+
+job_queue = JobQueue(
+    Config.JOB_WORKERS, Config.JOB_QUEUE_MAX, Config.USER_MAX_IN_FLIGHT, Config.USER_RATE_LIMIT
+)
+metrics.gauge("instagrap_jobs_in_flight", "Số job đang chạy trong worker", lambda: job_queue.busy)
+metrics.gauge("instagrap_jobs_queued", "Số job đang chờ trong hàng đợi", lambda: job_queue.stats()["depth"])
+
 async def process_instagram_url(update: Update, context: CallbackContext) -> None:
-    """Process Instagram URL and send media."""
+    """Nhận URL Instagram, xếp vào job_queue và báo vị trí chờ cho người dùng."""
     url = update.message.text.strip()
     
     if not re.match(INSTAGRAM_URL_PATTERN, url):
         await update.message.reply_text("Vui lòng gửi URL Instagram hợp lệ.")
         return
     
-    processing_message = await update.message.reply_text("⌛ Đang xử lý...")
+    chat_id = update.effective_chat.id
+    # Span gốc của request: theo job sang worker, kết thúc khi job xong (kể cả sau các lần hoãn)
+    trace = tracer.start("update", root=True, chat_id=chat_id, url=url)
+    if job_queue.full():
+        trace.attrs["outcome"] = "rejected"
+        tracer.finish(trace)
+        await update.message.reply_text("🚦 Bot đang quá tải, vui lòng thử lại sau ít phút.")
+        return
+    quota_wait = job_queue.quota_wait(chat_id)
+    if quota_wait:
+        trace.attrs["outcome"] = "rejected"
+        tracer.finish(trace)
+        await update.message.reply_text(
+            f"🚦 Bạn đã gửi quá nhiều link, vui lòng thử lại sau {max(1, int(quota_wait))} giây."
+        )
+        return
+    position = job_queue.position(chat_id)
+    if position:
+        processing_message = await update.message.reply_text(f"⏳ Đang chờ xử lý, vị trí #{position} trong hàng đợi")
+    else:
+        processing_message = await update.message.reply_text("⌛ Đang xử lý...")
+    # Việc tải / gửi chạy trong worker của job_queue, handler trả về ngay
+    job_queue.submit(DownloadJob(update, url, processing_message, trace=trace))
+
+async def run_download_job(job: DownloadJob) -> None:
+    """Tải và gửi một URL; bị Instagram giới hạn thì hoãn job vào delayed_retries, không ngủ tại chỗ."""
+    update, url, processing_message = job.update, job.url, job.processing_message
+    leased_paths = []
+    media_items = []
+    outcome = "failed"
+    root_token = tracer.attach(job.trace)
+    tracer.record("queue_wait", time.monotonic() - job.enqueued_at)
+    attempt = tracer.start("attempt", n=job.attempts + 1)
+    attempt_token = tracer.attach(attempt)
     
     try:
         # Extract information from URL
-        match = re.search(INSTAGRAM_URL_PATTERN, url)
-        first_part = match.group(1)
-        second_part = match.group(2) if match.group(2) else None
+        with metrics.stage_seconds.time(stage="url_parse"), tracer.span("url_parse"):
+            match = re.search(INSTAGRAM_URL_PATTERN, url)
+            first_part = match.group(1)
+            second_part = match.group(2) if match.group(2) else None
+            is_story = 'stories' in url or '/s/' in url
         
         await processing_message.edit_text("🔍 Đang kiểm tra URL...")
         
         # Xác định loại nội dung và tải xuống
-        if 'stories' in url or '/s/' in url:
+        if is_story:
             # URL là story
             username = first_part
             story_id = second_part
             await processing_message.edit_text(f"📥 Đang tải story của @{username}...")
-            media_items = await download_instagram_story(username, story_id)
+            with tracer.span("download", kind="story"):
+                media_items = await media_flights.do(
+                    f"story:{username}:{story_id or '*'}",
+                    lambda: download_instagram_story(username, story_id)
+                )
+            leased_paths = _media_paths(media_items)
             
             if media_items:
                 await processing_message.edit_text(f"✅ Đã tìm thấy {len(media_items)} story từ @{username}\n⌛ Đang chuẩn bị gửi...")
@@ -722,8 +3322,20 @@ async def process_instagram_url(update: Update, context: CallbackContext) -> Non
         else:
             # URL là post hoặc reel bình thường
             shortcode = first_part
-            await processing_message.edit_text("📥 Đang tải nội dung...")
-            media_items = await download_instagram_content(shortcode)
+            # Bài viết đã gửi trước đó: gửi lại bằng file_id, không cần Instagram hay CDN
+            media_pk = cl.media_pk_from_code(shortcode)
+            media_items = file_id_cache.get_post(media_pk)
+            if media_items:
+                logger.info(f"Cache hit file_id cho {shortcode} ({len(media_items)} item)")
+            else:
+                await processing_message.edit_text("📥 Đang tải nội dung...")
+                # Nhiều chat gửi cùng link: chỉ một lượt tải chạy, các chat khác chờ kết quả
+                with tracer.span("download", kind="media"):
+                    media_items = await media_flights.do(
+                        f"media:{media_pk}",
+                        lambda: download_instagram_content(shortcode, partial=job.partial)
+                    )
+                leased_paths = _media_paths(media_items)
         
         if not media_items:
             await processing_message.edit_text("⚠️ Không thể tải xuống. Nguyên nhân có thể:\n"
@@ -733,8 +3345,17 @@ async def process_instagram_url(update: Update, context: CallbackContext) -> Non
                                             "• Instagram đang giới hạn truy cập")
             return
         
+        # Ở chế độ media_group, thông tin bài viết thành caption của item đầu tiên
+        post_info = media_items[0].get("post_info")
+        post_info_as_caption = (
+            Config.TELEGRAM_DELIVERY_MODE == "media_group"
+            and len(media_items) > 1
+            and post_info is not None
+            and len(post_info) <= CAPTION_LIMIT
+        )
+        
         # Gửi thông tin bài viết với nút bấm
-        if media_items and "post_info" in media_items[0]:
+        if post_info is not None and not post_info_as_caption:
             keyboard = [[InlineKeyboardButton(
                 text=f"@{media_items[0]['username']}",
                 url=f"https://instagram.com/{media_items[0]['username']}"
@@ -742,154 +3363,115 @@ async def process_instagram_url(update: Update, context: CallbackContext) -> Non
             reply_markup = InlineKeyboardMarkup(keyboard)
             
             await update.message.reply_text(
-                media_items[0]["post_info"],
+                post_info,
                 reply_markup=reply_markup
             )
         
         await processing_message.edit_text(f"📤 Đang gửi {len(media_items)} file...")
         
-        success_videos = 0
-        success_images = 0
-        processed_files = set()  # Lưu trữ đường dẫn các file đã xử lý
-            
+        prepared = []
         for i, media_item in enumerate(media_items):
             try:
-                file_path = media_item["path"]
+                file_path = media_item.get("path")
                 media_type = media_item["type"]
                 
                 logger.info(f"Xử lý file {i+1}/{len(media_items)}")
-                logger.info(f"Đường dẫn: {file_path}")
                 logger.info(f"Loại file: {media_type}")
                 
-                if not os.path.exists(file_path):
-                    logger.error(f"File không tồn tại: {file_path}")
-                    continue
-                
-                file_size = os.path.getsize(file_path)
-                if file_size == 0:
-                    logger.error(f"File rỗng: {file_path}")
-                    continue
+                if media_item.get("file_id"):
+                    logger.info("Gửi lại bằng file_id đã cache")
+                elif _is_remote(media_item):
+                    logger.info("Chưa tải, gửi từ URL CDN")
+                else:
+                    logger.info(f"Đường dẫn: {file_path}")
+                    
+                    if not os.path.exists(file_path):
+                        logger.error(f"File không tồn tại: {file_path}")
+                        continue
+                    
+                    file_size = os.path.getsize(file_path)
+                    if file_size == 0:
+                        logger.error(f"File rỗng: {file_path}")
+                        continue
+                    
+                    logger.info(f"Chuẩn bị gửi file {file_path} (size: {file_size} bytes)")
                 
-                logger.info(f"Bắt đầu gửi file {file_path} (size: {file_size} bytes)")
+                # Tạo tên file với username, shortcode và số thứ tự
+                username = media_item.get("username", "unknown")
+                extension = 'mp4' if media_type == 'video' else 'jpg'
+                if is_story:
+                    # Đối với story, tính thời gian đã đăng
+                    taken_at = media_item.get("taken_at")
+                    
+                    # Tính số giờ đã trôi qua
+                    time_diff = time.time() - taken_at.timestamp()
+                    hours_ago = int(time_diff / 3600)
+                    
+                    # Tạo chuỗi thời gian
+                    if hours_ago == 0:
+                        time_str = "Just now"
+                    elif hours_ago == 1:
+                        time_str = "1H ago"
+                    else:
+                        time_str = f"{hours_ago}H ago"
+                    
+                    # Chỉ thêm số thứ tự nếu có nhiều story
+                    if len(media_items) > 1:
+                        filename = f"story_{i+1}.{extension}"
+                        caption = f"{media_type.capitalize()} {i+1}/{len(media_items)}\n🕒 {time_str}"
+                    else:
+                        filename = f"story.{extension}"
+                        caption = f"{media_type.capitalize()}\n🕒 {time_str}"
+                else:
+                    # Đối với post thường
+                    shortcode = first_part
+                    if len(media_items) > 1:
+                        filename = f"{shortcode}_{i+1}.{extension}"
+                        caption = f"{media_type.capitalize()} {i+1}/{len(media_items)}"
+                    else:
+                        filename = f"{shortcode}.{extension}"
+                        caption = f"{media_type.capitalize()}"
                 
-                try:
-                    with open(file_path, 'rb') as file:
-                        # Tạo tên file với username, shortcode và số thứ tự
-                        if 'stories' in file_path:
-                            # Đối với story, lấy username và tính thời gian đã đăng
-                            username = media_item.get("username", "unknown")
-                            taken_at = media_item.get("taken_at")
-                            
-                            # Tính số giờ đã trôi qua
-                            time_diff = time.time() - taken_at.timestamp()
-                            hours_ago = int(time_diff / 3600)
-                            
-                            # Tạo chuỗi thời gian
-                            if hours_ago == 0:
-                                time_str = "Just now"
-                            elif hours_ago == 1:
-                                time_str = "1H ago"
-                            else:
-                                time_str = f"{hours_ago}H ago"
-                            
-                            # Chỉ thêm số thứ tự nếu có nhiều story
-                            if len(media_items) > 1:
-                                filename = f"story_{i+1}.{'mp4' if media_type == 'video' else 'jpg'}"
-                                caption = f"{media_type.capitalize()} {i+1}/{len(media_items)}\n🕒 {time_str}"
-                            else:
-                                filename = f"story.{'mp4' if media_type == 'video' else 'jpg'}"
-                                caption = f"{media_type.capitalize()}\n🕒 {time_str}"
-                            
-                            # Gửi file với caption
-                            if media_type == "video":
-                                await update.message.reply_document(
-                                    document=file,
-                                    filename=filename,
-                                    caption=caption,
-                                    read_timeout=300,
-                                    write_timeout=300,
-                                    connect_timeout=60,
-                                    disable_content_type_detection=True
-                                )
-                                success_videos += 1
-                                processed_files.add(file_path)  # Add to processed files for deletion
-                                logger.info(f"Đã gửi thành công video {i+1}")
-                            else:  # image
-                                await update.message.reply_document(
-                                    document=file,
-                                    filename=filename,
-                                    caption=caption,
-                                    read_timeout=120,
-                                    write_timeout=120,
-                                    connect_timeout=60
-                                )
-                                success_images += 1
-                                processed_files.add(file_path)  # Add to processed files for deletion
-                                logger.info(f"Đã gửi thành công ảnh {i+1}")
-                        else:
-                            # Đối với post thường
-                            username = media_item.get("username", "unknown")
-                            shortcode = first_part
-                            if len(media_items) > 1:
-                                filename = f"{shortcode}_{i+1}.{'mp4' if media_type == 'video' else 'jpg'}"
-                                caption = f"{media_type.capitalize()} {i+1}/{len(media_items)}"
-                            else:
-                                filename = f"{shortcode}.{'mp4' if media_type == 'video' else 'jpg'}"
-                                caption = f"{media_type.capitalize()}"
-                            
-                            # Gửi file với caption
-                            if media_type == "video":
-                                await update.message.reply_document(
-                                    document=file,
-                                    filename=filename,
-                                    caption=caption,
-                                    read_timeout=300,
-                                    write_timeout=300,
-                                    connect_timeout=60,
-                                    disable_content_type_detection=True
-                                )
-                                success_videos += 1
-                                processed_files.add(file_path)  # Add to processed files for deletion
-                                logger.info(f"Đã gửi thành công video {i+1}")
-                            else:  # image
-                                await update.message.reply_document(
-                                    document=file,
-                                    filename=filename,
-                                    caption=caption,
-                                    read_timeout=120,
-                                    write_timeout=120,
-                                    connect_timeout=60
-                                )
-                                success_images += 1
-                                processed_files.add(file_path)  # Add to processed files for deletion
-                                logger.info(f"Đã gửi thành công ảnh {i+1}")
-                except Exception as send_error:
-                    logger.error(f"Lỗi khi gửi file {file_path}: {send_error}")
+                if post_info_as_caption and i == 0:
+                    caption = post_info
+                prepared.append({"item": media_item, "filename": filename, "caption": caption, "position": i})
             except Exception as e:
                 logger.error(f"Lỗi khi xử lý file {i+1}: {e}")
         
-        # Xóa các file đã gửi thành công
-        for file_path in processed_files:
-            try:
-                os.remove(file_path)
-                logger.info(f"Đã xóa file: {file_path}")
-            except Exception as e:
-                logger.error(f"Lỗi khi xóa file {file_path}: {e}")
-        
-        # Xóa thư mục của bài đăng nếu trống
-        if 'stories' in url or '/s/' in url:
-            post_dir = os.path.join(DOWNLOAD_DIR, f"stories_{first_part}")
-        else:
-            post_dir = os.path.join(DOWNLOAD_DIR, first_part)
+        success_videos = 0
+        success_images = 0
+        uploaded_new = False
+        with tracer.span("deliver", items=len(prepared)):
+            delivered = await deliver_media_items(update, prepared)
+        for media_item, kind, file_id in delivered:
+            if media_item["type"] == "video":
+                success_videos += 1
+            else:  # image
+                success_images += 1
             
-        try:
-            if os.path.exists(post_dir) and not os.listdir(post_dir):
-                os.rmdir(post_dir)
-                logger.info(f"Đã xóa thư mục rỗng: {post_dir}")
-        except Exception as e:
-            logger.error(f"Lỗi khi xóa thư mục {post_dir}: {e}")
+            # Lưu file_id để lần sau gửi lại không cần tải
+            if not media_item.get("file_id") and media_item.get("media_pk") and file_id:
+                file_id_cache.put_item(
+                    media_item["media_pk"],
+                    media_item.get("index", 0),
+                    file_id,
+                    media_item["type"],
+                    kind
+                )
+                uploaded_new = True
+        
+        # Ghi nhận bài viết để lần sau gửi lại cả bài bằng file_id
+        first_item = media_items[0]
+        if uploaded_new and not is_story and "item_count" in first_item:
+            file_id_cache.put_post(
+                first_item["media_pk"],
+                first_item["item_count"],
+                first_item.get("username", "unknown"),
+                first_item.get("post_info")
+            )
         
         if success_videos > 0 or success_images > 0:
+            outcome = "ok"
             status_message = []
             if success_videos > 0:
                 status_message.append(f"👉 {success_videos} video")
@@ -897,7 +3479,7 @@ async def process_instagram_url(update: Update, context: CallbackContext) -> Non
                 status_message.append(f"👉 {success_images} hình ảnh")
             
             # Thêm username vào thông báo thành công
-            if 'stories' in url or '/s/' in url:
+            if is_story:
                 await processing_message.edit_text(f"✅ Tải xuống story của @{username} thành công!\n\n" + "\n".join(status_message))
             else:
                 # Phân biệt giữa post và reel
@@ -906,9 +3488,45 @@ async def process_instagram_url(update: Update, context: CallbackContext) -> Non
         else:
             await processing_message.edit_text("❌ Không thể tải lên nội dung")
     
+    except RetryLater as e:
+        job.partial = e.partial or job.partial
+        if e.retry_after is None or job.attempts >= Config.DEFERRED_RETRY_MAX_ATTEMPTS or not retry_budget.try_spend():
+            logger.warning(f"Bỏ job {url} sau {job.attempts} lần hoãn")
+            outcome = "gave_up"
+            _discard_partial(job.partial)
+            await processing_message.edit_text(
+                "❌ Instagram vẫn đang giới hạn truy cập, vui lòng thử lại sau."
+            )
+            return
+        resume_at = delayed_retries.park(job, e.retry_after, job_queue.requeue)
+        outcome = "deferred"
+        await processing_message.edit_text(
+            f"⏳ Instagram đang giới hạn truy cập. Bot sẽ tự thử lại lúc "
+            f"{datetime.fromtimestamp(resume_at).strftime('%H:%M:%S')} "
+            f"(lần {job.attempts}/{Config.DEFERRED_RETRY_MAX_ATTEMPTS})"
+        )
+    except (AccountsUnavailable, CircuitOpenError) as e:
+        # Instagram đang sự cố / mọi tài khoản đang nghỉ: báo ngay, không thử thêm
+        outcome = "unavailable"
+        logger.warning(f"Từ chối xử lý {url}: {e}")
+        await processing_message.edit_text(f"⏳ {e}")
     except Exception as e:
-        logger.error(f"Lỗi xử lý URL Instagram: {e}")
+        attempt.error = f"{type(e).__name__}: {e}"
+        logger.error(f"Lỗi xử lý URL Instagram (req={attempt.trace_id}): {e}")
         await processing_message.edit_text(f"❌ Đã xảy ra lỗi: {str(e)}\nVui lòng thử lại sau.")
+    finally:
+        # Trả lease; file bị xóa khi chat cuối cùng dùng chung lượt tải đã gửi xong
+        media_leases.release(leased_paths + _local_lease_paths(media_items))
+        metrics.jobs.inc(outcome=outcome)
+        if outcome != "deferred":
+            metrics.stage_seconds.observe(time.monotonic() - job.created_at, stage="end_to_end")
+        tracer.detach(attempt_token)
+        attempt.attrs["outcome"] = outcome
+        tracer.finish(attempt)
+        tracer.detach(root_token)
+        if job.trace is not None and outcome != "deferred":
+            job.trace.attrs["outcome"] = outcome
+            tracer.finish(job.trace)
 
 async def start(update: Update, context: CallbackContext) -> None:
     """Send a message when the command /start is issued."""
@@ -1044,6 +3662,120 @@ async def about_command(update: Update, context: CallbackContext) -> None:
         ]])
     )
 
+def collect_stats() -> dict:
+    """Số liệu nội bộ của bot (executor, cache, pool, nguồn media_info...) để debug."""
+    return {
+        "executor": ig_executor.stats(),
+        "accounts": client_pool.stats(),
+        "media_strategies": media_strategy_stats.stats(),
+        "media_hedge": media_hedge_budget.stats(),
+        "circuit_breakers": {name: b.stats() for name, b in circuit_breakers.items()},
+        "retry_budget": retry_budget.stats(),
+        "delayed_retries": delayed_retries.stats(),
+        "jobs": job_queue.stats(),
+        "rate_limits": rate_limiter.stats(),
+        "file_id_cache": file_id_cache.stats(),
+        "media_meta_cache": media_meta_cache.stats(),
+        "media_disk_cache": media_disk_cache.stats(),
+        "flights": media_flights.stats(),
+        "tracing": tracer.stats(),
+    }
+
+async def stats_command(update: Update, context: CallbackContext) -> None:
+    """Gửi số liệu nội bộ khi admin dùng lệnh /stats."""
+    if update.effective_user is None or update.effective_user.id not in Config.ADMIN_USER_IDS:
+        return
+    text = json.dumps(collect_stats(), indent=1, ensure_ascii=False, default=str)
+    # Tin nhắn Telegram tối đa 4096 ký tự
+    await update.message.reply_text(text[:4096])
+
+async def on_shutdown(application: Application) -> None:
+    """Giải phóng tài nguyên dùng chung khi bot dừng."""
+    delayed_retries.cancel_all()
+    await job_queue.stop()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await close_http_session()
+    ig_executor.shutdown(wait=False)
+    file_id_cache.close()
+    media_meta_cache.close()
+    media_disk_cache.close()
+    logger.info("Đã dừng executor instagrapi")
+
+metrics_runner: web.AppRunner | None = None
+
+async def start_metrics_server() -> None:
+    """Chạy endpoint /metrics (text Prometheus) nếu METRICS_PORT được đặt."""
+    global metrics_runner
+    if not Config.METRICS_PORT:
+        return
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        body = await metrics.render_async()
+        return web.Response(
+            body=body.encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        )
+
+    server = web.Application()
+    server.router.add_get("/metrics", handle_metrics)
+    metrics_runner = web.AppRunner(server, access_log=None)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, Config.METRICS_LISTEN, Config.METRICS_PORT).start()
+    logger.info(f"Metrics tại http://{Config.METRICS_LISTEN}:{Config.METRICS_PORT}/metrics")
+
+async def run_webhook(application: Application) -> None:
+    """
+    Nhận update qua webhook bằng server aiohttp nhúng (không cần bản webhooks/tornado của
+    python-telegram-bot). Telegram gửi kèm header secret token để server xác thực.
+    """
+    async def handle_update(request: web.Request) -> web.Response:
+        if Config.WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != Config.WEBHOOK_SECRET:
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except Exception as e:
+            # Trả 200: trả lỗi thì Telegram gửi lại mãi update hỏng này
+            logger.warning(f"Bỏ qua update webhook không đọc được: {e}")
+            return web.Response()
+        await application.update_queue.put(update)
+        return web.Response()
+
+    server = web.Application()
+    server.router.add_post(Config.WEBHOOK_PATH, handle_update)
+    runner = web.AppRunner(server, access_log=None)
+    await runner.setup()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    try:
+        async with application:
+            try:
+                await application.start()
+                await set_bot_commands(application)
+                await web.TCPSite(runner, Config.WEBHOOK_LISTEN, Config.WEBHOOK_PORT).start()
+                await application.bot.set_webhook(
+                    url=Config.WEBHOOK_URL.rstrip("/") + Config.WEBHOOK_PATH,
+                    secret_token=Config.WEBHOOK_SECRET or None,
+                    max_connections=Config.WEBHOOK_MAX_CONNECTIONS,
+                    allowed_updates=Update.ALL_TYPES,
+                )
+                logger.info(
+                    f"Webhook đang nghe {Config.WEBHOOK_LISTEN}:{Config.WEBHOOK_PORT}{Config.WEBHOOK_PATH}"
+                )
+                await stop.wait()
+            finally:
+                # Ngừng nhận update trước rồi mới dừng application
+                await runner.cleanup()
+                if application.running:
+                    await application.stop()
+    finally:
+        # initialize() lỗi thì runner chưa được dọn ở trên; gọi cleanup lần nữa không sao
+        await runner.cleanup()
+        await on_shutdown(application)
+
 async def main() -> None:
     """Start the bot."""
     # Initialize Instagram client
@@ -1051,15 +3783,30 @@ async def main() -> None:
         logger.error("Failed to initialize Instagram client")
         return
     
+    # HTTP client dùng chung cho mọi lượt tải ảnh, video, story
+    global http_session
+    http_session = create_http_session()
+    
     # Create the Application
-    application = Application.builder().token(Config.TOKEN).build()
+    builder = Application.builder().token(Config.TOKEN).post_shutdown(on_shutdown)
+    if Config.TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(Config.TELEGRAM_API_BASE_URL)
+    application = builder.build()
 
     # Add handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("menu", menu))
+    application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, process_instagram_url))
     application.add_handler(CallbackQueryHandler(button_callback))
+    
+    job_queue.start(run_download_job)
+    await start_metrics_server()
+
+    if Config.BOT_MODE == "webhook":
+        await run_webhook(application)
+        return
 
     # Set bot commands
     await set_bot_commands(application)